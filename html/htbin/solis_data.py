@@ -7,9 +7,17 @@ import sys
 import time
 import calendar
 import struct
+import mmap
+import array
+import bisect
+import itertools
+import zlib
+import binascii
+import email.utils
 import urllib.parse
 
 sLog = '/home/pi/pysolis/log'
+bIndex = True                       # Save record time index files alongside the data
 
 def GetParam ():
     if ( len (sys.argv) > 1 ):
@@ -20,64 +28,94 @@ def GetParam ():
         return calendar.timegm (time.strptime (sys.argv[1], '%Y-%m-%d-%H-%M'))
     return int (urllib.parse.parse_qs (os.environ['QUERY_STRING'])['From'][0])
 
+def GetQuery ():
+    return urllib.parse.parse_qs (os.environ.get ('QUERY_STRING', ''))
+
+def GetTo (query):
+    # Optional end (exclusive) of the period requested. Without it data runs to the end of the day.
+    if ( 'To' in query ):
+        return int (query['To'][0])
+    return None
+
 class Source:
-    def GetFirst (self, treq):
+    # Day files are memory mapped. The record times are kept in a sidecar index file
+    # (<data file>.idx, unsigned 64-bit times in native byte order) which is created when first
+    # needed and extended as the data file grows, so that finding the first record
+    # requires no decoding. If the index cannot be written it is just held in memory.
+    def Open (self):
         try:
             self.f = open (self.sPath, 'rb')
-            # print ('Opened ' + self.sPath)
         except OSError:
-            return None
-        nlen = self.f.seek (0, os.SEEK_END)
-        self.nrec = nlen // self.reclen
-        # print ('nlen = {:d} = 0x{:X}, reclen = {:d}, nrec = {:d}'.format (nlen, nlen, self.reclen, self.nrec))
+            return False
+        self.nrec = os.fstat (self.f.fileno ()).st_size // self.reclen
         if ( self.nrec == 0 ):
+            return False
+        self.buf = mmap.mmap (self.f.fileno (), self.nrec * self.reclen, access = mmap.ACCESS_READ)
+        return True
+
+    def Time (self, irec):
+        return struct.unpack_from ('<Q', self.buf, irec * self.reclen + self.toff)[0]
+
+    def Times (self):
+        sIndex = self.sPath + '.idx'
+        times = array.array ('Q')
+        try:
+            with open (sIndex, 'rb') as f:
+                times.frombytes (f.read ())
+        except (OSError, ValueError):
+            times = array.array ('Q')
+        if (( len (times) > self.nrec ) or (( len (times) > 0 ) and ( times[-1] != self.Time (len (times) - 1) ))):
+            times = array.array ('Q')                           # Data file has been replaced
+        nidx = len (times)
+        if ( nidx < self.nrec ):
+            times.extend ([self.Time (irec) for irec in range (nidx, self.nrec)])
+            if ( bIndex ):
+                try:
+                    sTemp = '{:s}.{:d}'.format (sIndex, os.getpid ())
+                    with open (sTemp, 'wb') as f:
+                        f.write (times.tobytes ())
+                    os.replace (sTemp, sIndex)
+                except OSError:
+                    pass
+        return times
+
+    def GetFirst (self, treq):
+        if ( not self.Open () ):
             return None
-        r2 = self.nrec - 1
-        # print ('reclen = {:d}, r2 = {:d}, seek = {:X}'.format (self.reclen, r2, self.reclen * r2))
-        self.f.seek (self.reclen * r2)
-        d2 = self.Decode (self.f.read (self.reclen))
-        if ( d2[0] < treq ):
-            return None
-        r1 = 0
-        # print ('Seek 0')
-        self.f.seek (0)
-        d1 = self.Decode (self.f.read (self.reclen))
-        if ( d1[0] >= treq ):
-            self.irec = r1
-            return d1
-        while ( r2 - r1 > 1 ):
-            r3 = r1 + ((r2 - r1) * (treq - d1[0])) // ( d2[0] - d1[0] )
-            if ( r3 == r1 ):
-                r3 += 1
-            elif ( r3 == r2 ):
-                r3 -= 1
-            # print ('reclen = {:d}, r3 = {:d}, seek = {:X}'.format (self.reclen, r3, r3 * self.reclen))
-            self.f.seek ( r3 * self.reclen )
-            d3 = self.Decode (self.f.read (self.reclen))
-            if ( d3[0] < treq ):
-                r1 = r3
-                d1 = d3
-            else:
-                r2 = r3
-                d2 = d3
-        self.irec = r2 + 1
-        self.f.seek (self.irec * self.reclen)
-        return d2
+        self.irec = bisect.bisect_left (self.Times (), treq)
+        return self.GetNext ()
 
     def GetNext (self):
-        while (True):
-            if ( self.irec >= self.nrec ):
-                return None
+        while ( self.irec < self.nrec ):
+            ipos = self.irec * self.reclen
             self.irec += 1
-            r = self.Decode (self.f.read (self.reclen))
+            r = self.Decode (self.buf[ipos:ipos+self.reclen])
             if ( r is not None ):
                 return r
+        return None
+
+    def Records (self, treq):
+        r = self.GetFirst (treq)
+        while ( r is not None ):
+            yield r
+            r = self.GetNext ()
+        self.Close ()
+
+    def Close (self):
+        if ( hasattr (self, 'buf') ):
+            self.buf.close ()
+            del self.buf
+        if ( hasattr (self, 'f') ):
+            self.f.close ()
+            del self.f
 
 class Source1 (Source):
-    def __init__ (self, tm):
-        self.reclen = 306
-        if ( len (sys.argv) > 2 ):
-            self.sPath = sys.argv[2]
+    reclen = 306
+    toff = 2
+
+    def __init__ (self, tm, sPath = None):
+        if ( sPath is not None ):
+            self.sPath = sPath
         else:
             self.sPath = '{:s}/{:04d}/{:02d}/Solis_{:04d}{:02d}{:02d}.dat'.format (sLog, tm.tm_year, tm.tm_mon, tm.tm_year,
                                                                                    tm.tm_mon, tm.tm_mday)
@@ -86,9 +124,13 @@ class Source1 (Source):
         if ( len (rec) < self.reclen ):
             # sys.stderr.write ('Short Modbus record: {:d}\n'.format (len (rec)))
             return None
-        if (( rec[0:2] != b'\xAA\x55' ) or ( rec[self.reclen-2:] != b'\x55\xAA' )):
+        if (( rec[0:2] not in (b'\xAA\x55', b'\xAA\x56') ) or ( rec[self.reclen-2:] != b'\x55\xAA' )):
             sys.stderr.write ('Invalid Modbus record\n')
             return None
+        if (( rec[1] == 0x56 ) and
+            ( binascii.crc_hqx (rec[:22] + b'\x00\x00' + rec[24:], 0) != struct.unpack ('<H', rec[22:24])[0] )):
+            sys.stderr.write ('Modbus record checksum error\n')
+            return None
         t = struct.unpack ('<Q', rec[2:10])[0]
         w = struct.unpack ('<HH', rec[64:68])               # Total DC Input Power (W)
         solar = ( w[0] << 16 ) | w[1]
@@ -105,10 +147,12 @@ class Source1 (Source):
         return (t, load, solar, batt, grid, bsoc)
 
 class Source2 (Source):
-    def __init__ (self, tm):
-        self.reclen = 264
-        if ( len (sys.argv) > 3 ):
-            self.sPath = sys.argv[3]
+    reclen = 264
+    toff = 4
+
+    def __init__ (self, tm, sPath = None):
+        if ( sPath is not None ):
+            self.sPath = sPath
         else:
             self.sPath = '{:s}/{:04d}/{:02d}/Solis_R250_{:04d}{:02d}{:02d}.cap'.format (sLog, tm.tm_year, tm.tm_mon, tm.tm_year,
                                                                                         tm.tm_mon, tm.tm_mday)
@@ -136,38 +180,198 @@ class Source2 (Source):
         load = struct.unpack ('<H', rec[188:190])[0]        # Load power watts
         return (t, load, solar, batv * bata // 100, grid, bsoc)
 
-def Main ():
-    sys.stdout.write ('Context-type: text/csv\n\n')
-    t1 = 0
-    t2 = 0
-    treq = GetParam ()
-    tm = time.gmtime (treq)
-    s1 = Source1 (tm)
-    s2 = Source2 (tm)
-    r1 = s1.GetFirst (treq)
-    r2 = s2.GetFirst (treq)
+def Days (treq, tend):
+    # Start times of the days from treq up to tend, or just the day of treq
+    tday = int (treq) - int (treq) % 86400
+    if ( tend is None ):
+        return [tday]
+    return range (tday, max (int (tend), tday + 1), 86400)
+
+def DayRecords (cls, treq, tend):
+    # Records from treq up to tend, read lazily from consecutive day files
+    for tday in Days (treq, tend):
+        for r in cls (time.gmtime (tday)).Records (max (treq, tday)):
+            if (( tend is not None ) and ( r[0] >= tend )):
+                return
+            yield r
+
+def DayPaths (treq, tend):
+    return [cls (time.gmtime (tday)).sPath for tday in Days (treq, tend) for cls in (Source1, Source2)]
+
+def Merge (it1, it2, tlast):
+    # Merge the records from the Modbus and capture sources in time order.
+    # tlast is updated with the time of the last record taken from each source.
+    r1 = next (it1, None)
+    r2 = next (it2, None)
     while (True):
-        r = None
         if ( r1 is None ):
             if ( r2 is None ):
                 break
-            r = r2
-            t2 = r2[0]
-            r2 = s2.GetNext ()
+            yield r2
+            tlast[1] = r2[0]
+            r2 = next (it2, None)
         elif ( r2 is None ):
-            r = r1
-            t1 = r1[0]
-            r1 = s1.GetNext ()
+            yield r1
+            tlast[0] = r1[0]
+            r1 = next (it1, None)
         elif ( r1[0] < r2[0] ):
-            r = r1
-            t1 = r1[0]
-            r1 = s1.GetNext ()
+            yield r1
+            tlast[0] = r1[0]
+            r1 = next (it1, None)
         else:
-            r = r2
-            t2 = r2[0]
-            r2 = s2.GetNext ()
-        sys.stdout.write ('{:d},{:d},{:d},{:d},{:d},{:d}\n'.format (r[0], r[1], r[2], r[3], r[4], r[5]))
-    sys.stdout.write ('{:d},{:d}\n'.format (t1, t2))
+            yield r2
+            tlast[1] = r2[0]
+            r2 = next (it2, None)
+
+def Downsample (recs, treq, query, tend = None):
+    # Given Points=<n> or Bucket=<seconds> in the query, reduce the records from treq to tend
+    # (or the end of the day) to one per time bucket. Each column is reduced by Agg=mean
+    # (default), min or max, and the time of a bucket is the mean time of its records.
+    if ( tend is None ):
+        tend = int (treq) - int (treq) % 86400 + 86400
+    if ( 'Points' in query ):
+        npts = int (query['Points'][0])
+        if ( npts < 1 ):
+            raise ValueError ('Invalid downsampling parameters')
+        width = - ( - ( int (tend) - int (treq) ) // npts )
+    elif ( 'Bucket' in query ):
+        width = int (query['Bucket'][0])
+    else:
+        return recs
+    agg = query.get ('Agg', ['mean'])[0]
+    if (( width < 1 ) or ( agg not in ('mean', 'min', 'max') )):
+        raise ValueError ('Invalid downsampling parameters')
+    return Buckets (recs, int (treq), width, agg)
+
+def Buckets (recs, treq, width, agg, nchunk = 8192):
+    # Records are reduced a chunk at a time to the count, sum, minimum and maximum of each bucket.
+    # The last bucket of a chunk may continue into the next, so it is carried forward.
+    import numpy as np
+    carry = None
+    while (True):
+        data = np.array (list (itertools.islice (recs, nchunk)), dtype = np.int64).reshape (-1, 6)
+        if ( len (data) == 0 ):
+            break
+        ibkt = ( data[:, 0] - treq ) // width
+        start = np.flatnonzero (np.diff (ibkt, prepend = ibkt[0] - 1))
+        part = [ibkt[start], np.diff (np.append (start, len (data))), np.add.reduceat (data, start, axis = 0),
+                np.minimum.reduceat (data, start, axis = 0), np.maximum.reduceat (data, start, axis = 0)]
+        if ( carry is not None ):
+            if ( carry[0][0] == part[0][0] ):
+                part[1][0] += carry[1][0]
+                part[2][0] += carry[2][0]
+                part[3][0] = np.minimum (part[3][0], carry[3][0])
+                part[4][0] = np.maximum (part[4][0], carry[4][0])
+            else:
+                yield from BucketRows (carry, agg)
+        carry = [v[-1:] for v in part]
+        yield from BucketRows ([v[:-1] for v in part], agg)
+    if ( carry is not None ):
+        yield from BucketRows (carry, agg)
+
+def BucketRows (part, agg):
+    import numpy as np
+    ibkt, count, total, vmin, vmax = part
+    if ( agg == 'min' ):
+        data = vmin.copy ()
+    elif ( agg == 'max' ):
+        data = vmax.copy ()
+    else:
+        data = np.rint (total / count[:, None]).astype (np.int64)
+    data[:, 0] = total[:, 0] // count
+    return data.tolist ()
+
+def Format (r):
+    return '{:d},{:d},{:d},{:d},{:d},{:d}\n'.format (r[0], r[1], r[2], r[3], r[4], r[5])
+
+def Binary (recs, tlast, nblock = 4096):
+    # Binary response: the characters "SOL2", then blocks of up to nblock rows, each the number of
+    # rows followed by the six columns in turn. An empty block ends the data, and is followed by
+    # the times of the last Modbus and capture records. All values are 32-bit little-endian integers.
+    # Yields the buffers to be written in turn, so only one block of rows is held at a time.
+    yield b'SOL2'
+    while (True):
+        block = list (itertools.islice (recs, nblock))
+        if ( len (block) == 0 ):
+            break
+        yield struct.pack ('<I', len (block))
+        for icol in range (6):
+            col = array.array ('i', [r[icol] for r in block])
+            if ( sys.byteorder != 'little' ):
+                col.byteswap ()
+            yield col
+    yield struct.pack ('<Iii', 0, int (tlast[0]), int (tlast[1]))
 
-Main ()
+def WantBinary (query, sAccept):
+    return (( query.get ('Format', [''])[0] == 'bin' ) or ( 'application/octet-stream' in sAccept ))
+
+def Validators (lPath, sQuery, bBinary):
+    # Entity tag and last modification time of the response for a query on the given files.
+    # The format may be chosen by the Accept header, so the CSV and binary responses have different tags.
+    lTag = []
+    tmod = 0
+    for sPath in lPath:
+        try:
+            st = os.stat (sPath)
+            lTag.append ('{:x}-{:x}'.format (st.st_size, st.st_mtime_ns))
+            tmod = max (tmod, int (st.st_mtime))
+        except OSError:
+            lTag.append ('0')
+    sTag = '"{:s}-{:08x}-{:s}"'.format ('-'.join (lTag), zlib.crc32 (sQuery.encode ()), 'bin' if bBinary else 'csv')
+    return sTag, tmod
+
+def NotModified (sTag, tmod, sIfNoneMatch, sIfModifiedSince):
+    if ( sIfNoneMatch ):
+        return (( sIfNoneMatch.strip () == '*' ) or ( sTag in [s.strip () for s in sIfNoneMatch.split (',')] ))
+    if ( sIfModifiedSince ):
+        try:
+            return ( email.utils.parsedate_to_datetime (sIfModifiedSince).timestamp () >= tmod )
+        except (TypeError, ValueError):
+            pass
+    return False
+
+def CacheHeaders (sTag, tmod):
+    return [('ETag', sTag), ('Last-Modified', email.utils.formatdate (tmod, usegmt = True)),
+            ('Cache-Control', 'no-cache'), ('Vary', 'Accept')]
+
+def Main ():
+    treq = GetParam ()
+    query = GetQuery ()
+    tend = GetTo (query)
+    if ( len (sys.argv) > 2 ):
+        tm = time.gmtime (treq)
+        s1 = Source1 (tm, sys.argv[2])
+        s2 = Source2 (tm, sys.argv[3] if len (sys.argv) > 3 else None)
+        lPath = [s1.sPath, s2.sPath]
+        it1 = s1.Records (treq)
+        it2 = s2.Records (treq)
+    else:
+        lPath = DayPaths (treq, tend)
+        it1 = DayRecords (Source1, treq, tend)
+        it2 = DayRecords (Source2, treq, tend)
+    bBinary = WantBinary (query, os.environ.get ('HTTP_ACCEPT', ''))
+    sTag, tmod = Validators (lPath, os.environ.get ('QUERY_STRING', ''), bBinary)
+    lHdr = CacheHeaders (sTag, tmod)
+    # The standard Python CGI server does not act on a Status header, so cannot return 304
+    if (( not os.environ.get ('SERVER_SOFTWARE', '').startswith ('SimpleHTTP') ) and
+        NotModified (sTag, tmod, os.environ.get ('HTTP_IF_NONE_MATCH'), os.environ.get ('HTTP_IF_MODIFIED_SINCE'))):
+        sys.stdout.write ('Status: 304 Not Modified\n')
+        sys.stdout.write (''.join (['{:s}: {:s}\n'.format (k, v) for k, v in lHdr]) + '\n')
+        return
+    tlast = [0, 0]
+    recs = iter (Downsample (Merge (it1, it2, tlast), treq, query, tend))
+    if ( bBinary ):
+        sys.stdout.write ('Content-type: application/octet-stream\n')
+        sys.stdout.write (''.join (['{:s}: {:s}\n'.format (k, v) for k, v in lHdr]) + '\n')
+        sys.stdout.flush ()
+        for buf in Binary (recs, tlast):
+            sys.stdout.buffer.write (buf)
+        return
+    sys.stdout.write ('Content-type: text/csv\n')
+    sys.stdout.write (''.join (['{:s}: {:s}\n'.format (k, v) for k, v in lHdr]) + '\n')
+    for r in recs:
+        sys.stdout.write (Format (r))
+    sys.stdout.write ('{:d},{:d}\n'.format (tlast[0], tlast[1]))
 
+if __name__ == "__main__":
+    Main ()
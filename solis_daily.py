@@ -2,21 +2,38 @@
 #
 # Generate an HTML file showing daily Solar Power usage
 #
+import time
+tStart = time.perf_counter ()
 import os
 import sys
-import time
 import datetime
 import calendar
-import struct
 import csv
+import sqlite3
+import binascii
+import argparse
+import concurrent.futures
+import hashlib
+import fcntl
+import json
+import importlib.metadata
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
+tImport = time.perf_counter () - tStart
+plt = None                      # matplotlib modules, only imported when there are plots to draw (see Plotting)
+ticker = None
+tPlotImport = 0
 
 reclen1 = 306   # Modbus query record
 reclen2 = 264   # Captured 250 byte record
 sDataDir = '/home/pi/pysolis/log'
 sLogDir = '/home/pi/pysolis/html'
+sSummary = 'Solis_Summary.db'   # Database of daily totals, in the top level plot output folder
+nJobs = os.cpu_count ()         # Processes used to render the plots
+sRenderCache = 'Solis_Render.json'  # Keys of the plots drawn, in each plot output folder
+sCheckpoint = 'Solis_Backfill.json'  # Progress of a back-fill, in the top level plot output folder
+bDayPlots = True                # Draw the daily PNG plots as well as writing the day series
+tSeries = 120                   # Seconds averaged into each point of the day series for daily.html
+nRenderVersion = 1              # Increase to redraw all plots after changing how they are drawn
 
 rdTime = 0
 rdSolar = 1
@@ -35,48 +52,125 @@ skInvtr = 1
 skBatt = 2
 skGrid = 3
 
-def Decode1 (rec):
-    if ((rec[0] != 0xAA) or (rec[1] != 0x55) or (rec[-2] != 0x55) or (rec[-1] != 0xAA)):
-        sys.stderr.write ('Invalid Modbus record: 0x{:02X} 0x{:02X} 0x{:02X} 0x{:02X}\n'
-                          .format (rec[0], rec[1], rec[-2], rec[-1]))
-        return None
-    t = struct.unpack ('<Q', rec[2:10])[0]
-    w = struct.unpack ('<HH', rec[64:68])               # Total DC Input Power (W)
-    solar = ( w[0] << 16 ) | w[1]
-    w = struct.unpack ('<HH', rec[128:132])             # Meter Active Power
-    grid = ( w[0] << 16 ) | w[1]
-    if ( grid > 0x80000000 ):                           # +ve = Exporting
-        grid -= 0x100000000                             # -ve = Inporting
-    load = struct.unpack ('<H', rec[162:164])[0]        # House Load Power (W)
-    w = struct.unpack ('<HH', rec[166:170])             # Battery Power (W)
-    batt = ( w[0] << 16 ) | w[1]                        # +ve = Charging
-    if ( struct.unpack ('<H', rec[138:140])[0] > 0 ):   # Battery Current Direction
-        batt = -batt                                    # -ve = Discharging
-    bsoc = struct.unpack ('<H', rec[146:148])[0]
-    invtr = solar - load - batt - grid
-    return [t, solar, load, invtr, batt, grid, bsoc]
-
-def Decode2 (rec):
-    if ((rec[0] != 0xA5) or (rec[1] != 0x5A) or (rec[-2] != 0x5A) or (rec[-1] != 0xA5)):
-        sys.stderr.write ('Invalid Cloud Capture record: 0x{:02X} 0x{:02X} 0x{:02X} 0x{:02X}\n'
-                          .format (rec[0], rec[1], rec[-2], rec[-1]))
-        sys.exit (1)
-    t = struct.unpack ('<Q', rec[4:12])[0]
-    rec = rec[12:262]
-    solar = struct.unpack ('<H', rec[108:110])[0]       # Solar Power watts
-    grid = struct.unpack ('<H', rec[156:158])[0]        # power from/to grid (import is -ve)
-    if ( grid >= 0x8000 ):
-        grid -= 0x10000
-    batv = struct.unpack ('<H', rec[162:164])[0]        # Inverter Battery Voltage
-    bata = struct.unpack ('<H', rec[164:166])[0]        # Inverter Battery Current
-    bdir = struct.unpack ('<H', rec[166:168])[0]        # Inverter Battery Current Direction
-    if ( bdir > 0 ):
-        bata = -bata
-    bsoc = struct.unpack ('<H', rec[172:174])[0]        # BMS reported battery SOC
-    load = struct.unpack ('<H', rec[188:190])[0]        # Load power watts
-    batt = batv * bata // 100
-    invtr = solar - load - batt - grid
-    return [t, solar, load, invtr, batt, grid, bsoc]
+lSource = ['Solar', 'Battery', 'Grid']
+lSink = ['House', 'Inverter', 'Battery', 'Grid']
+
+# Fields used from the Modbus query record (see solis_dump.py for the full layout).
+# 32-bit values are stored as two little-endian words, most significant word first.
+dtype1 = np.dtype ({'names': ['start', 'time', 'solar', 'grid', 'bdir', 'soc', 'load', 'batt', 'end'],
+                    'formats': ['<u2', '<u8', ('<u2', 2), ('<u2', 2), '<u2', '<u2', '<u2', ('<u2', 2), '<u2'],
+                    'offsets': [0, 2, 64, 128, 138, 146, 162, 166, reclen1 - 2],
+                    'itemsize': reclen1})
+
+def Word32 (w):
+    return ( w[:, 0].astype (np.int64) << 16 ) | w[:, 1]
+
+def CheckSum (rec):
+    # Records starting 0xAA 0x56 hold a CRC-16 of their contents in reserved register 33028 (offset 22)
+    buf = rec.tobytes ()
+    valid = np.ones (len (rec), dtype = bool)
+    for i in np.nonzero (rec['start'] == 0x56AA)[0]:
+        r = buf[i*reclen1:(i+1)*reclen1]
+        valid[i] = ( binascii.crc_hqx (r[:22] + b'\x00\x00' + r[24:], 0) == int.from_bytes (r[22:24], 'little') )
+    return valid
+
+def Load1 (sFile):
+    nrec = os.path.getsize (sFile) // reclen1                   # Ignore any partly written record
+    rec = np.fromfile (sFile, dtype = dtype1, count = nrec)
+    valid = (( rec['start'] == 0x55AA ) | ( rec['start'] == 0x56AA )) & ( rec['end'] == 0xAA55 )
+    valid &= CheckSum (rec)
+    if ( not valid.all () ):
+        sys.stderr.write ('{:s}: {:d} invalid Modbus records\n'.format (sFile, nrec - valid.sum ()))
+        rec = rec[valid]
+    data = np.empty ((len (rec), 7), dtype = np.int64)
+    data[:, rdTime] = rec['time']
+    data[:, rdSolar] = Word32 (rec['solar'])                   # Total DC Input Power (W)
+    grid = Word32 (rec['grid'])                                 # Meter Active Power
+    data[:, rdGrid] = np.where (grid >= 0x80000000,             # +ve = Exporting
+                                grid - 0x100000000, grid)       # -ve = Inporting
+    data[:, rdLoad] = rec['load']                               # House Load Power (W)
+    batt = Word32 (rec['batt'])                                 # Battery Power (W)
+    data[:, rdBatt] = np.where (rec['bdir'] > 0, -batt, batt)   # +ve = Charging, -ve = Discharging
+    data[:, rdSoC] = rec['soc']
+    data[:, rdInvtr] = data[:, rdSolar] - data[:, rdLoad] - data[:, rdBatt] - data[:, rdGrid]
+    return data
+
+# Fields used from the captured 250 byte cloud record (see README.md).
+# The transmitted record starts at offset 12 of the capture record.
+dtype2 = np.dtype ({'names': ['start', 'time', 'solar', 'grid', 'batv', 'bata', 'bdir', 'soc', 'load', 'end'],
+                    'formats': ['<u2', '<u8', '<u2', '<i2', '<u2', '<u2', '<u2', '<u2', '<u2', '<u2'],
+                    'offsets': [0, 4, 120, 168, 174, 176, 178, 184, 200, reclen2 - 2],
+                    'itemsize': reclen2})
+
+def Load2 (sFile):
+    nrec = os.path.getsize (sFile) // reclen2                   # Ignore any partly written record
+    rec = np.fromfile (sFile, dtype = dtype2, count = nrec)
+    valid = ( rec['start'] == 0x5AA5 ) & ( rec['end'] == 0xA55A )
+    if ( not valid.all () ):
+        sys.stderr.write ('{:s}: {:d} invalid Cloud Capture records\n'.format (sFile, nrec - valid.sum ()))
+        rec = rec[valid]
+    data = np.empty ((len (rec), 7), dtype = np.int64)
+    data[:, rdTime] = rec['time']
+    data[:, rdSolar] = rec['solar']                             # Solar Power watts
+    data[:, rdGrid] = rec['grid']                               # power from/to grid (import is -ve)
+    data[:, rdLoad] = rec['load']                               # Load power watts
+    bata = rec['bata'].astype (np.int64)                        # Inverter Battery Current
+    bata = np.where (rec['bdir'] > 0, -bata, bata)              # Inverter Battery Current Direction
+    data[:, rdBatt] = rec['batv'] * bata // 100                 # Inverter Battery Voltage
+    data[:, rdSoC] = rec['soc']                                 # BMS reported battery SOC
+    data[:, rdInvtr] = data[:, rdSolar] - data[:, rdLoad] - data[:, rdBatt] - data[:, rdGrid]
+    return data
+
+def Merge (lsrc, prefer = None):
+    # Merge time ordered sources into a single time ordered array. Records with
+    # equal times are kept in source order unless prefer is the index of a source,
+    # in which case records from the other sources at the same time are dropped.
+    # The stable sort finds the existing ordered runs, so this is close to linear.
+    data = np.concatenate (lsrc)
+    isrc = np.repeat (np.arange (len (lsrc)), [len (src) for src in lsrc])
+    order = np.argsort (data[:, rdTime], kind = 'stable')
+    data = data[order]
+    if ( prefer is not None ):
+        isrc = isrc[order]
+        keep = ( isrc == prefer ) | ~ np.isin (data[:, rdTime], lsrc[prefer][:, rdTime])
+        data = data[keep]
+    return data
+
+def Allocate (data, tday, tend = None):
+    # Energy (kWh) from each source to each sink for every sample, shape (N, 3, 4).
+    # Each sample covers the interval between the mid-points to its neighbours,
+    # with the first and last extended to the start of the day and tend (default the end of the day).
+    ntime = len (data)
+    flow = np.zeros ((ntime, 3, 4))
+    if ( ntime == 0 ):
+        return flow
+    t = data[:, rdTime].astype (float)
+    tmid = ( t[:-1] + t[1:] ) / 2
+    if ( tend is None ):
+        tend = tday + 86400
+    dt = np.diff (np.concatenate (([float (tday)], tmid, [float (tend)])))
+    src = np.zeros ((ntime, 3))
+    sink = np.zeros ((ntime, 4))
+    src[:, scSolar] = data[:, rdSolar]
+    src[:, scBatt] = np.maximum (- data[:, rdBatt], 0)
+    src[:, scGrid] = np.maximum (- data[:, rdGrid], 0)
+    sink[:, skGrid] = np.maximum (data[:, rdGrid], 0)
+    sink[:, skBatt] = np.maximum (data[:, rdBatt], 0)
+    sink[:, skInvtr] = data[:, rdInvtr]
+    sink[:, skHouse] = data[:, rdLoad]
+    # Each source in turn supplies the sinks in a fixed order until it is exhausted.
+    # The loops are over the 3 x 4 matrix only, each step handles all samples at once.
+    for sc in [scSolar, scBatt, scGrid]:
+        active = src[:, sc] != 0.0
+        for sk in [skGrid, skBatt, skInvtr, skHouse]:
+            over = src[:, sc] > sink[:, sk]
+            use = np.where (active, np.where (over, sink[:, sk], src[:, sc]), 0.0)
+            flow[:, sc, sk] = dt * use
+            src[:, sc] -= use
+            sink[:, sk] -= use
+            active &= over
+    flow /= 3.6E6
+    return flow
 
 def TimeFmt (t, pos):
     t = datetime.datetime.fromtimestamp (t)
@@ -114,115 +208,263 @@ def Status (t, data):
     status.append ((ts, t2 - ts, c2))
     return status
 
+class Summary:
+    # Daily energy flows from each source to each sink (kWh) and battery state of charge range (%),
+    # keyed by date (yyyymmdd) in an SQLite database. Storing a day replaces any earlier totals for it.
+    def __init__ (self, sFile):
+        self.cols = ['{:s}_{:s}'.format (sSrc, sSink) for sSrc in lSource for sSink in lSink]
+        self.db = sqlite3.connect (sFile)
+        self.db.execute ('PRAGMA journal_mode=WAL')
+        self.db.execute ('CREATE TABLE IF NOT EXISTS daily (day INTEGER PRIMARY KEY, '
+                         + ', '.join ([c + ' REAL' for c in self.cols]) + ', socmin INTEGER, socmax INTEGER)')
+        # Cached totals for each month (period yyyymm) and year (yyyy), removed when one of their days changes
+        self.db.execute ('CREATE TABLE IF NOT EXISTS totals (period INTEGER PRIMARY KEY, '
+                         + ', '.join ([c + ' REAL' for c in self.cols]) + ', socmin INTEGER, socmax INTEGER)')
+        self.db.commit ()
+        if ( self.db.execute ('PRAGMA user_version').fetchone ()[0] == 0 ):
+            # First use of the database, so the yearly and lifetime totals include the earlier months
+            self.ImportAll (os.path.dirname (os.path.abspath (sFile)))
+            self.db.execute ('PRAGMA user_version = 1')
+
+    def Put (self, rows):
+        # Rows of (year, month, day, use[3,4], socmin, socmax)
+        with self.db:
+            self.db.executemany ('DELETE FROM totals WHERE period IN (?, ?)',
+                                 set ([(100 * year + mon, year) for year, mon, mday, use, socmin, socmax in rows]))
+            self.db.executemany ('INSERT OR REPLACE INTO daily VALUES (' + ', '.join (['?'] * 15) + ')',
+                                 [[10000 * year + 100 * mon + mday] + [float (u) for u in use.ravel ()] + [socmin, socmax]
+                                  for year, mon, mday, use, socmin, socmax in rows])
+
+    def Get (self, tm1, tm2):
+        # Days from tm1 to tm2 inclusive: (dates as yyyymmdd, use[N,3,4], soc[N,2] of min and max)
+        rows = self.db.execute ('SELECT day, ' + ', '.join (self.cols) + ', socmin, socmax FROM daily '
+                                + 'WHERE day BETWEEN ? AND ? ORDER BY day',
+                                (10000 * tm1.tm_year + 100 * tm1.tm_mon + tm1.tm_mday,
+                                 10000 * tm2.tm_year + 100 * tm2.tm_mon + tm2.tm_mday)).fetchall ()
+        rows = np.array (rows, dtype = np.float64).reshape ((-1, 15))
+        return rows[:, 0].astype (np.int64), rows[:, 1:13].reshape ((-1, 3, 4)), rows[:, 13:15].astype (np.int64)
+
+    def Totals (self, lo, hi, scale):
+        # Totals for each month (scale 100, periods yyyymm) or year (scale 10000, periods yyyy) from lo to
+        # hi inclusive, with the minimum and maximum state of charge. Periods not already in the cache are
+        # summed from the days and stored.
+        lPeriod = [p for p in range (lo, hi + 1) if (( scale == 10000 ) or ( 1 <= p % 100 <= 12 ))]
+        sCols = ', '.join (self.cols) + ', socmin, socmax'
+        cached = set ([row[0] for row in self.db.execute ('SELECT period FROM totals WHERE period BETWEEN ? AND ?',
+                                                          (lo, hi))])
+        with self.db:
+            for p in lPeriod:
+                if ( p not in cached ):
+                    self.db.execute ('INSERT INTO totals SELECT ?, ' + ', '.join (['SUM ({:s})'.format (c) for c in self.cols])
+                                     + ', MIN (socmin), MAX (socmax) FROM daily WHERE day BETWEEN ? AND ? HAVING COUNT (*) > 0',
+                                     (p, p * scale, p * scale + scale - 1))
+        rows = self.db.execute ('SELECT period, ' + sCols + ' FROM totals WHERE period BETWEEN ? AND ? ORDER BY period',
+                                (lo, hi)).fetchall ()
+        rows = np.array (rows, dtype = np.float64).reshape ((-1, 15))
+        return rows[:, 0].astype (np.int64), rows[:, 1:13].reshape ((-1, 3, 4)), rows[:, 13:15].astype (np.int64)
+
+    def Years (self):
+        # First and last years with data
+        first, last = self.db.execute ('SELECT MIN (day), MAX (day) FROM daily').fetchone ()
+        if ( first is None ):
+            return 0, -1
+        return first // 10000, last // 10000
+
+    def Month (self, sDir, tm):
+        # The days of the month, first importing the month's CSV file if the database has none of them
+        tm1 = time.struct_time ((tm.tm_year, tm.tm_mon, 1, 0, 0, 0, 0, 0, 0))
+        tm2 = time.struct_time ((tm.tm_year, tm.tm_mon, 31, 0, 0, 0, 0, 0, 0))
+        days, use, soc = self.Get (tm1, tm2)
+        sFile = MonthlyCSV (sDir, tm)
+        if (( len (days) == 0 ) and os.path.exists (sFile) ):
+            self.Import (sFile)
+            days, use, soc = self.Get (tm1, tm2)
+        return days, use, soc
+
+    def ImportAll (self, sRoot):
+        # Import the monthly CSV files from earlier versions anywhere under sRoot, for months with no days
+        for sDir, lDir, lFile in os.walk (sRoot):
+            for sName in sorted (lFile):
+                if (( len (sName) == 24 ) and sName.startswith ('Solis_Monthly_') and sName.endswith ('.csv')
+                    and sName[14:20].isdigit ()):
+                    self.Month (sDir, time.strptime (sName[14:20], '%Y%m'))
+
+    def WriteCSV (self, sDir, tm):
+        # Rewrite the month's CSV file from the database
+        days, use, soc = self.Month (sDir, tm)
+        os.makedirs (sDir, exist_ok = True)
+        sFile = MonthlyCSV (sDir, tm)
+        sTemp = '{:s}.{:d}.tmp'.format (sFile, os.getpid ())
+        with open (sTemp, 'w') as f:
+            f.write ('Year,Month,Day')
+            for sSrc in lSource:
+                for sSink in lSink:
+                    f.write (',{:s} to {:s}'.format (sSrc, sSink))
+            f.write ('\n')
+            for i in range (len (days)):
+                f.write ('{:d},{:d},{:d}'.format (tm.tm_year, tm.tm_mon, days[i] % 100))
+                for sc in [scSolar, scBatt, scGrid]:
+                    for sk in [skHouse, skInvtr, skBatt, skGrid]:
+                        f.write (',{:5.3f}'.format (use[i, sc, sk]))
+                f.write (',{:d},{:d}\n'.format (soc[i, 0], soc[i, 1]))
+        os.replace (sTemp, sFile)
+
+    def Import (self, sFile):
+        # Load a CSV file written by earlier versions. Where a day appears more than once the last is kept.
+        rows = []
+        with open (sFile, 'r', newline='') as f:
+            for row in csv.reader (f):
+                if (( len (row) >= 15 ) and row[0].isdigit () ):
+                    use = np.array ([float (v) for v in row[3:15]]).reshape ((3, 4))
+                    if ( len (row) >= 17 ):
+                        rows.append ((int (row[0]), int (row[1]), int (row[2]), use, int (row[15]), int (row[16])))
+                    else:
+                        rows.append ((int (row[0]), int (row[1]), int (row[2]), use, 0, 0))
+        self.Put (rows)
+
+def MonthlyCSV (sDir, tm):
+    return os.path.join (sDir, 'Solis_Monthly_{:04d}{:02d}.csv'.format (tm.tm_year, tm.tm_mon))
+
+def Plotting ():
+    # Import matplotlib, which takes several seconds on a Pi, the first time that a plot is drawn
+    global plt, ticker, tPlotImport
+    if ( plt is None ):
+        t = time.perf_counter ()
+        import matplotlib
+        matplotlib.use ('Agg')
+        import matplotlib.pyplot
+        import matplotlib.ticker
+        plt = matplotlib.pyplot
+        ticker = matplotlib.ticker
+        tPlotImport = time.perf_counter () - t
+
+def PlotJob (obj, sPlot, args):
+    Plotting ()
+    getattr (obj, sPlot) (*args)
+
+def RenderKey (obj, sPlot, args):
+    # Hash of everything a plot is drawn from: the data held by the object, the method and its arguments
+    h = hashlib.sha1 ('{:d} {:s} {:s} {!r}'.format (nRenderVersion, importlib.metadata.version ('matplotlib'), sPlot, args).encode ())
+    for k, v in sorted (obj.__dict__.items ()):
+        h.update (k.encode ())
+        if ( isinstance (v, np.ndarray) ):
+            h.update ('{:s} {!r}'.format (v.dtype.str, v.shape).encode ())
+            h.update (np.ascontiguousarray (v).tobytes ())
+        else:
+            h.update (repr (v).encode ())
+    return h.hexdigest ()
+
+def Render (jobs):
+    # Draw the plots, given as (object, method name, arguments, output file), in parallel processes.
+    # The key of each plot drawn is kept in a cache file in its folder, and plots whose key is
+    # unchanged since they were last drawn are skipped.
+    caches = {}
+    todo = []
+    for obj, sPlot, args, sFile in jobs:
+        sDir, sName = os.path.split (sFile)
+        if ( sDir not in caches ):
+            try:
+                with open (os.path.join (sDir, sRenderCache), 'r') as f:
+                    caches[sDir] = json.load (f)
+            except (OSError, ValueError):
+                caches[sDir] = {}
+        key = RenderKey (obj, sPlot, args)
+        if (( caches[sDir].get (sName) != key ) or ( not os.path.exists (sFile) )):
+            todo.append ((obj, sPlot, args, sDir, sName, key))
+    if ( len (todo) == 0 ):
+        return
+    Plotting ()                                                 # Once here, rather than in each process
+    if ( nJobs <= 1 ):
+        for obj, sPlot, args, sDir, sName, key in todo:
+            PlotJob (obj, sPlot, args)
+    else:
+        with concurrent.futures.ProcessPoolExecutor (min (nJobs, len (todo))) as pool:
+            for f in [pool.submit (PlotJob, obj, sPlot, args) for obj, sPlot, args, sDir, sName, key in todo]:
+                f.result ()
+    # Other processes (such as back-fill workers) may draw plots in the same folder, so each cache file
+    # is re-read and replaced holding a lock. The cache file itself is replaced, so a separate file is locked.
+    for sDir in set ([job[3] for job in todo]):
+        sFile = os.path.join (sDir, sRenderCache)
+        with open (sFile + '.lock', 'w') as fLock:
+            fcntl.flock (fLock, fcntl.LOCK_EX)
+            try:
+                with open (sFile, 'r') as f:
+                    cache = json.load (f)
+            except (OSError, ValueError):
+                cache = {}
+            for obj, sPlot, args, sDir2, sName, key in todo:
+                if ( sDir2 == sDir ):
+                    cache[sName] = key
+            sTemp = '{:s}.{:d}.tmp'.format (sFile, os.getpid ())
+            with open (sTemp, 'w') as f:
+                json.dump (cache, f, indent = 0, sort_keys = True)
+            os.replace (sTemp, sFile)
+
 class Daily:
-    def Load (self, sDir, tm):
+    def Load (self, sDir, tm, prefer = None):
         tday = calendar.timegm (tm)
         tday -= tday % 86400
-        data1 = []
-        data2 = []
+        data1 = np.zeros ((0, 7), dtype = np.int64)
+        data2 = np.zeros ((0, 7), dtype = np.int64)
         sFile = os.path.join (sDir, 'Solis_{:04d}{:02d}{:02d}.dat'.format (tm.tm_year, tm.tm_mon, tm.tm_mday))
         if ( os.path.exists (sFile) ):
-            with open (sFile, 'rb') as f:
-                while (True):
-                    rec = f.read (reclen1)
-                    if ( not rec ):
-                        break
-                    rec = Decode1 (rec)
-                    if ( rec is not None ):
-                        data1.append (rec)
+            data1 = Load1 (sFile)
         self.status1 = Status (tday, data1)
         sFile = os.path.join (sDir, 'Solis_R250_{:04d}{:02d}{:02d}.cap'.format (tm.tm_year, tm.tm_mon, tm.tm_mday))
         if ( os.path.exists (sFile) ):
-            with open (sFile, 'rb') as f:
-                while (True):
-                    rec = f.read (reclen2)
-                    if ( not rec ):
-                        break
-                    data2.append (Decode2 (rec))
+            data2 = Load2 (sFile)
         self.status2 = Status (tday, data2)
-        self.data = []
-        while (True):
-            if ( len (data1) == 0 ):
-                self.data.extend (data2)
-                break
-            elif ( len (data2) == 0 ):
-                self.data.extend (data1)
-                break
-            elif ( data1[0][0] <= data2[0][0] ):
-                self.data.append (data1.pop (0))
-            else:
-                self.data.append (data2.pop (0))
-        ntime = len (self.data)
-        # print (self.data)
-        self.data = np.array (self.data)
-
-        self.use = np.zeros ((3, 4))
-        src = [0.0, 0.0, 0.0]
-        sink = [0.0, 0.0, 0.0, 0.0]
-        for i in range (ntime):
-            # Work around an integer arithmetic bug in Python 3.9.2 - Convert times to float
-            if ( i == 0 ):
-                # t2 = ( self.data[0, rdTime] + self.data[1, rdTime] ) // 2
-                t2 = ( float (self.data[0, rdTime]) + float (self.data[1, rdTime]) ) / 2
-                # dt = t2 - tday
-                dt = t2 - float (tday)
-            elif ( i == ntime - 1 ):
-                t1 = t2
-                # dt = tday + 86400 - t1
-                dt = float(tday) + 86400 - t1
-            else:
-                t1 = t2
-                # t2 = ( self.data[i, rdTime] + self.data[i+1, rdTime] ) // 2
-                t2 = ( float (self.data[i, rdTime]) + float (self.data[i+1, rdTime]) ) / 2
-                dt = t2 - t1
-            src[scSolar] = self.data[i, rdSolar]
-            if ( self.data[i, rdGrid] >= 0.0 ):
-                sink[skGrid] = self.data[i, rdGrid]
-                src[scGrid] = 0.0
-            else:
-                sink[skGrid] = 0
-                src[scGrid] = - self.data[i, rdGrid]
-            if ( self.data[i, rdBatt] >= 0.0 ):
-                sink[skBatt] = self.data[i, rdBatt]
-                src[scBatt] = 0.0
+        self.data = Merge ([data1, data2], prefer)
+
+        # A day not yet over is only totalled to its last record, rather than extrapolated to midnight
+        tend = tday + 86400
+        if (( tend > time.time () ) and ( len (self.data) > 0 )):
+            tend = max (self.data[-1, rdTime], tday)
+        self.flow = Allocate (self.data, tday, tend)
+        self.use = self.flow.sum (0)
+
+    def Store (self, sDir, tm, summary, bImport = True):
+        if ( bImport ):
+            summary.Month (sDir, tm)                            # Imports any CSV file from earlier versions
+        summary.Put ([(tm.tm_year, tm.tm_mon, tm.tm_mday, self.use,
+                       int (self.data[:, rdSoC].min ()), int (self.data[:, rdSoC].max ()))])
+
+    def Log (self, sDir, tm, summary):
+        # Store the day's totals, then rewrite the month's CSV file from the database
+        self.Store (sDir, tm, summary)
+        summary.WriteCSV (sDir, tm)
+
+    def Series (self, sDir, tm):
+        # Write the data for the charts drawn by daily.html: the power and state of charge averaged over
+        # tSeries second intervals (intervals without data are left out), the status intervals and the
+        # energy from each source to each sink. Times are seconds from the start of the day.
+        tday = calendar.timegm (tm)
+        tday -= tday % 86400
+        ibkt = ( self.data[:, rdTime] - tday ) // tSeries
+        ifst = np.r_[0, np.flatnonzero (np.diff (ibkt)) + 1][:len (ibkt)]
+        nrec = np.diff (np.append (ifst, len (ibkt)))
+        series = {'time': ( ibkt[ifst] * tSeries + tSeries // 2 ).tolist ()}
+        for sCol, icol in [('solar', rdSolar), ('load', rdLoad), ('inverter', rdInvtr), ('battery', rdBatt),
+                           ('grid', rdGrid), ('soc', rdSoC)]:
+            if ( len (ifst) > 0 ):
+                series[sCol] = np.round (np.add.reduceat (self.data[:, icol], ifst) / nrec).astype (np.int64).tolist ()
             else:
-                sink[skBatt] = 0.0
-                src[scBatt] = -self.data[i, rdBatt]
-            sink[skInvtr] = self.data[i, rdInvtr]
-            sink[skHouse] = self.data[i, rdLoad]
-            for sc in [scSolar, scBatt, scGrid]:
-                if ( src[sc] == 0.0 ):
-                    continue
-                for sk in [skGrid, skBatt, skInvtr, skHouse]:
-                    if ( src[sc] > sink[sk] ):
-                        self.use[sc, sk] += dt * sink[sk]
-                        src[sc] -= sink[sk]
-                        sink[sk] = 0.0
-                    else:
-                        self.use[sc, sk] += dt * src[sc]
-                        sink[sk] -= src[sc]
-                        src[sc] = 0.0
-                        break
-        self.use /= 3.6E6
-
-    def Log (self, sDir, tm):
-        sFile = os.path.join (sDir, 'Solis_Monthly_{:04d}{:02d}.csv'.format (tm.tm_year, tm.tm_mon))
-        if ( os.path.exists (sFile) ):
-            f = open (sFile, 'a')
-        else:
-            os.makedirs (sDir, exist_ok = True)
-            f = open (sFile, 'w')
-            f.write ('Year,Month,Day')
-            for sSrc in ['Solar', 'Battery', 'Grid']:
-                for sSink in ['House', 'Inverter', 'Battery', 'Grid']:
-                    f.write (',{:s} to {:s}'.format (sSrc, sSink))
-            f.write ('\n')
-        f.write ('{:d},{:d},{:d}'.format (tm.tm_year, tm.tm_mon, tm.tm_mday))
-        for sc in [scSolar, scBatt, scGrid]:
-            for sk in [skHouse, skInvtr, skBatt, skGrid]:
-                f.write (',{:5.3f}'.format (self.use[sc, sk]))
-        f.write (',{:d},{:d}\n'.format (self.data[:, rdSoC].min (), self.data[:, rdSoC].max ()))
-        f.close ()
+                series[sCol] = []
+        day = {'date': '{:04d}-{:02d}-{:02d}'.format (tm.tm_year, tm.tm_mon, tm.tm_mday),
+               'start': int (tday),
+               'step': tSeries,
+               'series': series,
+               'status': {'modbus': [[int (ts - tday), int (wth), int (clr == '#00FF00')] for ts, wth, clr in self.status1],
+                          'cloud': [[int (ts - tday), int (wth), int (clr == '#00FF00')] for ts, wth, clr in self.status2]},
+               'sources': lSource,
+               'sinks': lSink,
+               'use': np.round (self.use, 3).tolist ()}
+        os.makedirs (sDir, exist_ok = True)
+        sFile = os.path.join (sDir, 'Day_{:04d}{:02d}{:02d}.json'.format (tm.tm_year, tm.tm_mon, tm.tm_mday))
+        sTemp = '{:s}.{:d}.tmp'.format (sFile, os.getpid ())
+        with open (sTemp, 'w') as f:
+            json.dump (day, f, separators = (',', ':'))
+        os.replace (sTemp, sFile)
 
     def StatusPlt (self, sDir, tm):
         fig = plt.figure (figsize=(10.0, 1.0), dpi = 100, facecolor='w')
@@ -244,9 +486,8 @@ class Daily:
         ax.set_yticks ([1.0, 2.0])
         ax.yaxis.set_major_formatter (ticker.FuncFormatter(lambda x, p: {1.0: 'Modbus', 2.0: 'Cloud'}[x]))
         ax.invert_yaxis ()
-        fig.savefig (os.path.join (sDir, 'Status_{:04d}{:02d}{:02d}.png'
-                                   .format (tm.tm_year, tm.tm_mon, tm.tm_mday)),
-                     format = 'png')
+        fig.savefig (self.File (sDir, 'Status', tm), format = 'png')
+        plt.close (fig)
 
     def PowerPlt (self, sDir, tm):
         fig = plt.figure (figsize=(10.0, 7.5), dpi = 100, facecolor='w')
@@ -269,9 +510,8 @@ class Daily:
         ax.legend (loc='upper center', ncol=5)
         ax.xaxis.set_major_formatter (ticker.FuncFormatter(TimeFmt))
         ax.xaxis.set_major_locator (ticker.LinearLocator (numticks = 13))
-        fig.savefig (os.path.join (sDir, 'Power_{:04d}{:02d}{:02d}.png'
-                                   .format (tm.tm_year, tm.tm_mon, tm.tm_mday)),
-                     format = 'png')
+        fig.savefig (self.File (sDir, 'Power', tm), format = 'png')
+        plt.close (fig)
 
     def BatteryPlt (self, sDir, tm):
         fig = plt.figure (figsize=(10.0, 4.5), dpi = 100, facecolor='w')
@@ -291,9 +531,8 @@ class Daily:
         ax.xaxis.set_major_formatter (ticker.FuncFormatter(TimeFmt))
         ax.xaxis.set_major_locator (ticker.LinearLocator (numticks = 13))
         ax.yaxis.set_major_formatter (ticker.PercentFormatter ())
-        fig.savefig (os.path.join (sDir, 'Battery_{:04d}{:02d}{:02d}.png'
-                                   .format (tm.tm_year, tm.tm_mon, tm.tm_mday)),
-                     format = 'png')
+        fig.savefig (self.File (sDir, 'Battery', tm), format = 'png')
+        plt.close (fig)
 
     def Scaler (self, s):
         return lambda x: '{:5.3f} kWh'.format (s * x / 100)
@@ -310,9 +549,8 @@ class Daily:
                 center = (2.25, 2.25),
                 normalize = True)
         ax.set_title (time.strftime ('%d %B %Y', tm) + ' Consumed Power')
-        fig.savefig (os.path.join (sDir, 'Consume_{:04d}{:02d}{:02d}.png'
-                                   .format (tm.tm_year, tm.tm_mon, tm.tm_mday)),
-                     format = 'png')
+        fig.savefig (self.File (sDir, 'Consume', tm), format = 'png')
+        plt.close (fig)
 
     def ProducePie (self, sDir, tm):
         fig = plt.figure (figsize=(4.5, 4.5), dpi = 100, facecolor='w')
@@ -325,143 +563,120 @@ class Daily:
                 center = (2.25, 2.25),
                 normalize = True)
         ax.set_title (time.strftime ('%d %B %Y', tm) + ' Produced Power')
-        fig.savefig (os.path.join (sDir, 'Produce_{:04d}{:02d}{:02d}.png'
-                                   .format (tm.tm_year, tm.tm_mon, tm.tm_mday)),
-                     format = 'png')
+        fig.savefig (self.File (sDir, 'Produce', tm), format = 'png')
+        plt.close (fig)
+
+    def File (self, sDir, sPlot, tm):
+        return os.path.join (sDir, '{:s}_{:04d}{:02d}{:02d}.png'.format (sPlot, tm.tm_year, tm.tm_mon, tm.tm_mday))
 
-    def Process (self, sDDir, sLDir, tm):
+    def Plots (self, sDir, tm):
+        return [(self, sMethod, (sDir, tm), self.File (sDir, sPlot, tm))
+                for sMethod, sPlot in [('StatusPlt', 'Status'), ('ConsumePie', 'Consume'), ('ProducePie', 'Produce'),
+                                       ('PowerPlt', 'Power'), ('BatteryPlt', 'Battery')]]
+
+    def Process (self, sDDir, sLDir, tm, summary):
         self.Load (sDDir, tm)
-        self.Log (sLDir, tm)
-        self.StatusPlt (sLDir, tm)
-        self.ConsumePie (sLDir, tm)
-        self.ProducePie (sLDir, tm)
-        self.PowerPlt (sLDir, tm)
-        self.BatteryPlt (sLDir, tm)
-
-class Monthly:
-    def Load (self, sDir, tm):
-        sFile = os.path.join (sDir, 'Solis_Monthly_{:04d}{:02d}.csv'.format (tm.tm_year, tm.tm_mon))
-        with open (sFile, 'r', newline='') as f:
-            nrow = 0
-            self.days = []
-            self.data = [[[], [], [], []], [[], [], [], []], [[], [], [], []]]
-            self.soc = []
-            for row in csv.reader (f):
-                nrow += 1
-                if (( nrow > 1 ) and ( len (row) >= 15 )):
-                    self.days.append (int (row[2]))
-                    icol = 3
-                    for sc in [scSolar, scBatt, scGrid]:
-                        d1 = []
-                        for sk in [skHouse, skInvtr, skBatt, skGrid]:
-                            self.data[sc][sk].append (float (row[icol]))
-                            icol += 1
-                    if ( len (row) >= 17 ):
-                        socmin = int (row[15])
-                        socmax = int (row[16])
-                        self.soc.append ((socmin, socmax - socmin))
-                    else:
-                        self.soc.append ((0, 0))
-        self.days = np.array (self.days)
-        self.data = np.array (self.data)
-        self.soc = np.array (self.soc)
-        self.ndays = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)[tm.tm_mon - 1]
-        if (( tm.tm_mon == 2 ) and ( tm.tm_year % 100 == 0 )):
-            self.ndays = 29
+        self.Log (sLDir, tm, summary)
+        self.Series (sLDir, tm)
+        Render (self.Plots (sLDir, tm))
+
+class Period:
+    # Plots of the energy flows and battery state of charge for each day of a month, each month of a
+    # year, or each year. The subclass loads self.x (positions), self.data (totals [source, sink, x])
+    # and self.soc (minimum and range of state of charge [x, 2]), and sets the axis and title text.
+    def Axis (self, ax):
+        ax.xaxis.set_major_locator (ticker.MaxNLocator (steps=[1, 2, 5, 10]))
+
+    def File (self, sDir, sPlot):
+        return os.path.join (sDir, '{:s}_{:s}{:s}.png'.format (self.name, sPlot, self.suffix))
 
-    def ConsumePlt (self, sDir, tm):
+    def Save (self, fig, sDir, sPlot):
+        fig.savefig (self.File (sDir, sPlot), format = 'png')
+        plt.close (fig)
+
+    def ConsumePlt (self, sDir):
         fig = plt.figure (figsize=(10.0, 4.5), dpi = 100, facecolor='w')
         ax = fig.add_axes ([0.1, 0.1, 0.85, 0.85])
-        ax.set_xlim (0.5, self.ndays + 0.5)
+        ax.set_xlim (self.xlim)
         consume = self.data[scSolar, :, :] + self.data[scBatt, :, :] + self.data[scGrid, :, :]
-        ax.bar (self.days, consume[skInvtr, :], color='#FFFF00', label='Inverter')
-        ax.bar (self.days, consume[skHouse, :], bottom=consume[skInvtr, :], color='#00FF00', label='House')
-        ax.xaxis.set_major_locator (ticker.MaxNLocator (steps=[1, 2, 5, 10]))
+        ax.bar (self.x, consume[skInvtr, :], color='#FFFF00', label='Inverter')
+        ax.bar (self.x, consume[skHouse, :], bottom=consume[skInvtr, :], color='#00FF00', label='House')
+        self.Axis (ax)
         ax.yaxis.grid (which='major')
-        ax.set_xlabel ('Day of the Month')
+        ax.set_xlabel (self.xlabel)
         ax.set_ylabel ('Energy (kWh)')
-        ax.set_title ('Energy Consumption ' + time.strftime ('%B %Y', tm))
-        fig.savefig (os.path.join (sDir, 'Monthly_Consume_{:04d}{:02d}.png'
-                                   .format (tm.tm_year, tm.tm_mon)),
-                     format = 'png')
+        ax.set_title ('Energy Consumption ' + self.when)
+        self.Save (fig, sDir, 'Consume')
 
-    def SupplyPlt (self, sDir, tm):
+    def SupplyPlt (self, sDir):
         fig = plt.figure (figsize=(10.0, 4.5), dpi = 100, facecolor='w')
         ax = fig.add_axes ([0.1, 0.1, 0.85, 0.85])
-        ax.set_xlim (0.5, self.ndays + 0.5)
+        ax.set_xlim (self.xlim)
         supply = self.data[:,skHouse,:] + self.data[:,skInvtr,:]
-        ax.bar (self.days, supply[scGrid, :], color='#FF0000', label='Grid')
-        ax.bar (self.days, supply[scBatt, :], bottom=supply[scGrid, :], color='#0000FF', label='Battery')
-        ax.bar (self.days, supply[scSolar, :], bottom=supply[scGrid, :] + supply[scBatt, :],
+        ax.bar (self.x, supply[scGrid, :], color='#FF0000', label='Grid')
+        ax.bar (self.x, supply[scBatt, :], bottom=supply[scGrid, :], color='#0000FF', label='Battery')
+        ax.bar (self.x, supply[scSolar, :], bottom=supply[scGrid, :] + supply[scBatt, :],
                 color='#00FF00', label='Solar')
-        ax.xaxis.set_major_locator (ticker.MaxNLocator (steps=[1, 2, 5, 10]))
+        self.Axis (ax)
         ax.yaxis.grid (which='major')
-        ax.set_xlabel ('Day of the Month')
+        ax.set_xlabel (self.xlabel)
         ax.set_ylabel ('Energy (kWh)')
-        ax.set_title ('Energy Supply ' + time.strftime ('%B %Y', tm))
-        fig.savefig (os.path.join (sDir, 'Monthly_Supply_{:04d}{:02d}.png'
-                                   .format (tm.tm_year, tm.tm_mon)),
-                     format = 'png')
+        ax.set_title ('Energy Supply ' + self.when)
+        self.Save (fig, sDir, 'Supply')
 
-    def ProducePlt (self, sDir, tm):
+    def ProducePlt (self, sDir):
         fig = plt.figure (figsize=(10.0, 4.5), dpi = 100, facecolor='w')
         ax = fig.add_axes ([0.1, 0.1, 0.85, 0.85])
-        ax.set_xlim (0.5, self.ndays + 0.5)
-        ax.bar (self.days, self.data[scSolar, skGrid, :], color='#FF0000', label='Grid')
-        ax.bar (self.days, self.data[scSolar, skBatt, :], bottom=self.data[scSolar, skGrid, :],
+        ax.set_xlim (self.xlim)
+        ax.bar (self.x, self.data[scSolar, skGrid, :], color='#FF0000', label='Grid')
+        ax.bar (self.x, self.data[scSolar, skBatt, :], bottom=self.data[scSolar, skGrid, :],
                 color='#0000FF', label='Battery')
-        ax.bar (self.days, self.data[scSolar, skInvtr, :],
+        ax.bar (self.x, self.data[scSolar, skInvtr, :],
                 bottom=self.data[scSolar, skGrid, :] + self.data[scSolar, skBatt, :],
                 color = '#FFFF00', label='Inverter')
-        ax.bar (self.days, self.data[scSolar, skHouse, :],
+        ax.bar (self.x, self.data[scSolar, skHouse, :],
                 bottom=self.data[scSolar, skGrid, :] + self.data[scSolar, skBatt, :]
                 + self.data[scSolar, skInvtr, :],
                 color = '#00FF00', label='House')
-        ax.xaxis.set_major_locator (ticker.MaxNLocator (steps=[1, 2, 5, 10]))
+        self.Axis (ax)
         ax.yaxis.grid (which='major')
-        ax.set_xlabel ('Day of the Month')
+        ax.set_xlabel (self.xlabel)
         ax.set_ylabel ('Energy (kWh)')
-        ax.set_title ('Energy Production ' + time.strftime ('%B %Y', tm))
-        fig.savefig (os.path.join (sDir, 'Monthly_Produce_{:04d}{:02d}.png'
-                                   .format (tm.tm_year, tm.tm_mon)),
-                     format = 'png')
+        ax.set_title ('Energy Production ' + self.when)
+        self.Save (fig, sDir, 'Produce')
 
-    def GridPlt (self, sDir, tm):
+    def GridPlt (self, sDir):
         fig = plt.figure (figsize=(10.0, 4.5), dpi = 100, facecolor='w')
         ax = fig.add_axes ([0.1, 0.1, 0.85, 0.85])
-        ax.set_xlim (0.5, self.ndays + 0.5)
-        ax.bar (self.days, self.data[scGrid, skBatt, :], color='#0000FF', label='Battery')
-        ax.bar (self.days, self.data[scGrid, skInvtr, :], bottom=self.data[scGrid, skBatt, :],
+        ax.set_xlim (self.xlim)
+        ax.bar (self.x, self.data[scGrid, skBatt, :], color='#0000FF', label='Battery')
+        ax.bar (self.x, self.data[scGrid, skInvtr, :], bottom=self.data[scGrid, skBatt, :],
                 color = '#FFFF00', label='Inverter')
-        ax.bar (self.days, self.data[scGrid, skHouse, :],
+        ax.bar (self.x, self.data[scGrid, skHouse, :],
                 bottom=self.data[scGrid, skBatt, :] + self.data[scGrid, skInvtr, :],
                 color = '#00FF00', label='House')
-        ax.xaxis.set_major_locator (ticker.MaxNLocator (steps=[1, 2, 5, 10]))
+        self.Axis (ax)
         ax.yaxis.grid (which='major')
-        ax.set_xlabel ('Day of the Month')
+        ax.set_xlabel (self.xlabel)
         ax.set_ylabel ('Energy (kWh)')
-        ax.set_title ('Grid Power Use ' + time.strftime ('%B %Y', tm))
-        fig.savefig (os.path.join (sDir, 'Monthly_Grid_{:04d}{:02d}.png'
-                                   .format (tm.tm_year, tm.tm_mon)),
-                     format = 'png')
+        ax.set_title ('Grid Power Use ' + self.when)
+        self.Save (fig, sDir, 'Grid')
 
-    def BatteryPlt (self, sDir, tm):
+    def BatteryPlt (self, sDir):
         fig = plt.figure (figsize=(10.0, 4.5), dpi = 100, facecolor='w')
         ax = fig.add_axes ([0.1, 0.1, 0.85, 0.85])
-        ax.set_xlim (0.5, self.ndays + 0.5)
+        ax.set_xlim (self.xlim)
         ax.set_ylim (0.0, 100.0)
-        ax.xaxis.set_major_locator (ticker.MaxNLocator (steps=[1, 2, 5, 10]))
+        self.Axis (ax)
         ax.yaxis.set_major_formatter (ticker.PercentFormatter ())
         ax.yaxis.grid (which='major')
-        ax.set_xlabel ('Day of the Month')
+        ax.set_xlabel (self.xlabel)
         ax.set_ylabel ('State of Charge (%)')
-        ax.set_title ('Battery Charge ' + time.strftime ('%B %Y', tm))
-        ax.bar (self.days, self.soc[:, 1], bottom=self.soc[:, 0], color='#0000FF', label='Battery')
-        fig.savefig (os.path.join (sDir, 'Monthly_Battery_{:04d}{:02d}.png'
-                                   .format (tm.tm_year, tm.tm_mon)),
-                     format = 'png')
+        ax.set_title ('Battery Charge ' + self.when)
+        ax.bar (self.x, self.soc[:, 1], bottom=self.soc[:, 0], color='#0000FF', label='Battery')
+        self.Save (fig, sDir, 'Battery')
 
-    def SavePlt (self, sDir, tm):
+    def SavingPlt (self, sDir):
         save = self.data[:, skHouse, :].sum (0) - self.data[scGrid, :, :].sum (0);
         clr = []
         for s in save:
@@ -471,40 +686,276 @@ class Monthly:
                 clr.append ('#00FF00')
         fig = plt.figure (figsize=(10.0, 4.5), dpi = 100, facecolor='w')
         ax = fig.add_axes ([0.1, 0.1, 0.85, 0.85])
-        ax.set_xlim (0.5, self.ndays + 0.5)
-        ax.xaxis.set_major_locator (ticker.MaxNLocator (steps=[1, 2, 5, 10]))
+        ax.set_xlim (self.xlim)
+        self.Axis (ax)
         ax.yaxis.grid (which='major')
-        ax.set_xlabel ('Day of the Month')
+        ax.set_xlabel (self.xlabel)
         ax.set_ylabel ('Power Saving (kWh)')
-        ax.set_title ('Power Saving ' + time.strftime ('%B %Y', tm))
-        ax.bar (self.days, save, color = clr)
-        fig.savefig (os.path.join (sDir, 'Monthly_Saving_{:04d}{:02d}.png'
-                                   .format (tm.tm_year, tm.tm_mon)),
-                     format = 'png')
-
-    def Process (self, sDir, tm):
-        self.Load (sDir, tm)
-        self.ConsumePlt (sDir, tm)
-        self.SupplyPlt (sDir, tm)
-        self.ProducePlt (sDir, tm)
-        self.GridPlt (sDir, tm)
-        self.BatteryPlt (sDir, tm)
-        self.SavePlt (sDir, tm)
+        ax.set_title ('Power Saving ' + self.when)
+        ax.bar (self.x, save, color = clr)
+        self.Save (fig, sDir, 'Saving')
+
+    def Plots (self, sDir):
+        return [(self, sPlot + 'Plt', (sDir,), self.File (sDir, sPlot))
+                for sPlot in ['Consume', 'Supply', 'Produce', 'Grid', 'Battery', 'Saving']]
+
+class Monthly (Period):
+    def Load (self, sDir, tm, summary):
+        days, use, soc = summary.Month (sDir, tm)
+        self.x = days % 100
+        self.data = use.transpose ((1, 2, 0))
+        self.soc = np.stack ((soc[:, 0], soc[:, 1] - soc[:, 0]), axis = 1)
+        self.ndays = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)[tm.tm_mon - 1]
+        if (( tm.tm_mon == 2 ) and ( tm.tm_year % 100 == 0 )):
+            self.ndays = 29
+        self.xlim = (0.5, self.ndays + 0.5)
+        self.xlabel = 'Day of the Month'
+        self.when = time.strftime ('%B %Y', tm)
+        self.name = 'Monthly'
+        self.suffix = '_{:04d}{:02d}'.format (tm.tm_year, tm.tm_mon)
+
+    def Process (self, sDir, tm, summary):
+        self.Load (sDir, tm, summary)
+        Render (self.Plots (sDir))
+
+class Yearly (Period):
+    def Load (self, tm, summary):
+        months, use, soc = summary.Totals (100 * tm.tm_year + 1, 100 * tm.tm_year + 12, 100)
+        self.x = months % 100
+        self.data = use.transpose ((1, 2, 0))
+        self.soc = np.stack ((soc[:, 0], soc[:, 1] - soc[:, 0]), axis = 1)
+        self.xlim = (0.5, 12.5)
+        self.xlabel = 'Month'
+        self.when = '{:04d}'.format (tm.tm_year)
+        self.name = 'Yearly'
+        self.suffix = '_{:04d}'.format (tm.tm_year)
+
+    def Axis (self, ax):
+        ax.set_xticks (range (1, 13), ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                       'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])
+
+    def Process (self, sDir, tm, summary):
+        self.Load (tm, summary)
+        Render (self.Plots (sDir))
+
+class Lifetime (Period):
+    def Load (self, summary):
+        first, last = summary.Years ()
+        years, use, soc = summary.Totals (first, last, 10000)
+        self.x = years
+        self.data = use.transpose ((1, 2, 0))
+        self.soc = np.stack ((soc[:, 0], soc[:, 1] - soc[:, 0]), axis = 1)
+        if ( len (years) > 0 ):
+            self.xlim = (years[0] - 0.5, years[-1] + 0.5)
+            self.when = '{:d} - {:d}'.format (years[0], years[-1])
+        else:
+            self.xlim = (-0.5, 0.5)
+            self.when = ''
+        self.xlabel = 'Year'
+        self.name = 'Lifetime'
+        self.suffix = ''
+
+    def Axis (self, ax):
+        ax.xaxis.set_major_locator (ticker.MaxNLocator (steps=[1, 2, 5, 10], integer = True))
+
+    def Process (self, sDir, summary):
+        self.Load (summary)
+        Render (self.Plots (sDir))
+
+def BackfillDay (sDDir, sLDir, sDb, sDay, bPlot, bDayPlots):
+    # Process one day of a back-fill, in a worker process. Returns False if there is no data for the day.
+    global nJobs
+    nJobs = 1                                                   # Days are already processed in parallel
+    tm = time.strptime (sDay, '%Y-%m-%d')
+    daily = Daily ()
+    daily.Load (sDDir, tm)
+    if ( len (daily.data) == 0 ):
+        return False
+    os.makedirs (sLDir, exist_ok = True)
+    daily.Store (sLDir, tm, Summary (sDb), False)              # CSV files already imported by Backfill
+    daily.Series (sLDir, tm)
+    if ( bPlot and bDayPlots ):
+        Render (daily.Plots (sLDir, tm))
+    return True
+
+def BackfillMonth (sLDir, sDb, sMonth, bPlot):
+    # The monthly stage of a back-fill, run once all the days of the month in the range are done
+    global nJobs
+    nJobs = 1
+    tm = time.strptime (sMonth, '%Y-%m')
+    summary = Summary (sDb)
+    summary.WriteCSV (sLDir, tm)
+    if ( bPlot ):
+        monthly = Monthly ()
+        monthly.Load (sLDir, tm, summary)
+        Render (monthly.Plots (sLDir))
+
+def Backfill (sFrom, sTo, bRestart, bPlot, bDayPlots):
+    # Process every day from sFrom to sTo inclusive in parallel, then the monthly plots for each month and
+    # the yearly and lifetime plots. Progress is recorded in a checkpoint file, so that an interrupted
+    # back-fill of the same dates continues from where it stopped.
+    t1 = calendar.timegm (time.strptime (sFrom, '%Y-%m-%d'))
+    t2 = calendar.timegm (time.strptime (sTo, '%Y-%m-%d'))
+    lDay = [time.strftime ('%Y-%m-%d', time.gmtime (t)) for t in range (t1, t2 + 1, 86400)]
+    sCheck = os.path.join (sLogDir, sCheckpoint)
+    check = {'from': sFrom, 'to': sTo, 'days': [], 'months': []}
+    if ( not bRestart ):
+        try:
+            with open (sCheck, 'r') as f:
+                last = json.load (f)
+            if (( last['from'] == sFrom ) and ( last['to'] == sTo )):
+                check = last
+                print ('Resuming: {:d} of {:d} days already done'.format (len (check['days']), len (lDay)))
+        except (OSError, ValueError, KeyError):
+            pass
+    def Save ():
+        sTemp = sCheck + '.tmp'
+        with open (sTemp, 'w') as f:
+            json.dump (check, f)
+        os.replace (sTemp, sCheck)
+    os.makedirs (sLogDir, exist_ok = True)
+    sDb = os.path.join (sLogDir, sSummary)
+    summary = Summary (sDb)                                     # Create the database before the workers use it
+    # Import any CSV files from earlier versions now, as a worker importing one could otherwise
+    # replace a day that another worker has just stored
+    for sMonth in sorted (set ([sDay[:7] for sDay in lDay])):
+        summary.Month (os.path.join (sLogDir, sMonth[:4], sMonth[5:7]), time.strptime (sMonth, '%Y-%m'))
+    summary.db.close ()                                         # Not to be inherited by the workers
+    dMonth = {}                                                 # Days of each month still to do
+    for sDay in lDay:
+        dMonth.setdefault (sDay[:7], set ())
+        if ( sDay not in check['days'] ):
+            dMonth[sDay[:7]].add (sDay)
+    with concurrent.futures.ProcessPoolExecutor (nJobs) as pool:
+        pending = {}
+        for sMonth in dMonth:
+            if (( len (dMonth[sMonth]) == 0 ) and ( sMonth not in check['months'] )):
+                pending[pool.submit (BackfillMonth, os.path.join (sLogDir, sMonth[:4], sMonth[5:7]), sDb, sMonth, bPlot)] = ('month', sMonth)
+        for sDay in lDay:
+            if ( sDay not in check['days'] ):
+                pending[pool.submit (BackfillDay, os.path.join (sDataDir, sDay[:4], sDay[5:7]),
+                                     os.path.join (sLogDir, sDay[:4], sDay[5:7]), sDb, sDay, bPlot, bDayPlots)] = ('day', sDay)
+        while ( len (pending) > 0 ):
+            done, waiting = concurrent.futures.wait (pending, return_when = concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                sType, sWhen = pending.pop (f)
+                bData = f.result ()
+                if ( sType == 'day' ):
+                    if ( not bData ):
+                        print ('{:s}: No data'.format (sWhen))
+                    check['days'].append (sWhen)
+                    sMonth = sWhen[:7]
+                    dMonth[sMonth].discard (sWhen)
+                    if ( len (dMonth[sMonth]) == 0 ):
+                        pending[pool.submit (BackfillMonth, os.path.join (sLogDir, sMonth[:4], sMonth[5:7]),
+                                             sDb, sMonth, bPlot)] = ('month', sMonth)
+                else:
+                    check['months'].append (sWhen)
+                    print ('{:s}: Done'.format (sWhen))
+                Save ()
+    os.remove (sCheck)
+    if ( not bPlot ):
+        return
+    summary = Summary (sDb)
+    jobs = []
+    for sYear in sorted (set ([sDay[:4] for sDay in lDay])):
+        yearly = Yearly ()
+        yearly.Load (time.strptime (sYear, '%Y'), summary)
+        jobs += yearly.Plots (os.path.join (sLogDir, sYear))
+    lifetime = Lifetime ()
+    lifetime.Load (summary)
+    Render (jobs + lifetime.Plots (sLogDir))
+
+def Timing (bShow, lTime):
+    # Report the time of the module imports, and the time taken by each stage from the elapsed
+    # times at their ends. Start-up includes the imports, and Plots the matplotlib import.
+    if ( bShow ):
+        sys.stderr.write ('Imports {:.3f}s'.format (tImport))
+        if ( plt is not None ):
+            sys.stderr.write (', matplotlib import {:.3f}s'.format (tPlotImport))
+        tPrev = 0
+        for sStage, t in lTime:
+            sys.stderr.write (', {:s} {:.3f}s'.format (sStage, t - tPrev))
+            tPrev = t
+        sys.stderr.write (', Total {:.3f}s\n'.format (time.perf_counter () - tStart))
 
 def Main ():
-    if ( len (sys.argv) > 1 ):
-        tm = time.strptime (sys.argv[1], '%Y-%m-%d')
+    global sDataDir, sLogDir, nJobs, bDayPlots
+    parser = argparse.ArgumentParser (description = 'Generate plots of Solar PV data for a day, and its month and year')
+    parser.add_argument ('--from', dest = 'sFrom', help = 'Back-fill the days from this date (yyyy-mm-dd)')
+    parser.add_argument ('--to', dest = 'sTo', help = 'Last date to back-fill (default yesterday)')
+    parser.add_argument ('--restart', action = 'store_true', help = 'Ignore the checkpoint of an interrupted back-fill')
+    parser.add_argument ('--data', help = 'Top level folder of the binary data (default {:s})'.format (sDataDir))
+    parser.add_argument ('--plots', help = 'Top level folder for the plot output (default {:s})'.format (sLogDir))
+    parser.add_argument ('--jobs', type = int, default = nJobs, help = 'Number of processes to use')
+    parser.add_argument ('--no-plots', dest = 'bPlot', action = 'store_false',
+                         help = 'Only update the daily totals and monthly CSV file, without drawing any plots')
+    parser.add_argument ('--no-day-plots', dest = 'bDayPlots', action = 'store_false',
+                         help = 'Do not draw the daily plots, daily.html draws them from the day series file')
+    parser.add_argument ('--timing', action = 'store_true', help = 'Report the time taken by each stage')
+    parser.add_argument ('date', nargs = '?', help = 'Date to process (yyyy-mm-dd, default yesterday)')
+    parser.add_argument ('ddir', nargs = '?', help = 'Folder containing the data for the date, and the plot output')
+    parser.add_argument ('ldir', nargs = '?', help = 'Folder for the plot output, if different')
+    args = parser.parse_args ()
+    if ( args.data is not None ):
+        sDataDir = args.data
+    if ( args.plots is not None ):
+        sLogDir = args.plots
+    nJobs = max (args.jobs, 1)
+    bDayPlots = args.bDayPlots
+    if ( args.sFrom is not None ):
+        sTo = args.sTo
+        if ( sTo is None ):
+            sTo = time.strftime ('%Y-%m-%d', time.localtime (time.time () - 86400))
+        Backfill (args.sFrom, sTo, args.restart, args.bPlot, bDayPlots)
+        Timing (args.timing, [])
+        return
+    if ( args.date is not None ):
+        tm = time.strptime (args.date, '%Y-%m-%d')
     else:
         tm = time.localtime (time.time () - 86400)
     sDDir = os.path.join (sDataDir, '{:04d}'.format (tm.tm_year), '{:02d}'.format (tm.tm_mon))
     sLDir = os.path.join (sLogDir, '{:04d}'.format (tm.tm_year), '{:02d}'.format (tm.tm_mon))
-    if ( len (sys.argv) == 3 ):
-        sDDir = sys.argv[2]
-        sLDir = sys.argv[2]
-    elif ( len (sys.argv) > 3 ):
-        sDDir = sys.argv[2]
-        sLDir = sys.argv[3]
-    Daily ().Process (sDDir, sLDir, tm)
-    Monthly ().Process (sLDir, tm)
-
-Main ()
+    sYDir = os.path.join (sLogDir, '{:04d}'.format (tm.tm_year))
+    sTDir = sLogDir
+    bPeriod = True
+    if ( args.ddir is not None ):
+        # The database is kept with the plots, so only holds the days processed into this folder,
+        # and the yearly and lifetime plots would be incomplete
+        sDDir = args.ddir
+        sLDir = args.ddir
+        if ( args.ldir is not None ):
+            sLDir = args.ldir
+        sTDir = sLDir
+        bPeriod = False
+    sDb = os.path.join (sTDir, sSummary)
+    os.makedirs (sTDir, exist_ok = True)
+    summary = Summary (sDb)
+    lTime = [('Start-up', time.perf_counter () - tStart)]
+    daily = Daily ()
+    daily.Load (sDDir, tm)
+    lTime.append (('Load', time.perf_counter () - tStart))
+    daily.Log (sLDir, tm, summary)
+    daily.Series (sLDir, tm)
+    lTime.append (('Log', time.perf_counter () - tStart))
+    if ( not args.bPlot ):
+        Timing (args.timing, lTime)
+        return
+    monthly = Monthly ()
+    monthly.Load (sLDir, tm, summary)
+    # Render all the plots together, to keep every process busy
+    jobs = monthly.Plots (sLDir)
+    if ( bPeriod ):
+        yearly = Yearly ()
+        yearly.Load (tm, summary)
+        lifetime = Lifetime ()
+        lifetime.Load (summary)
+        jobs += yearly.Plots (sYDir) + lifetime.Plots (sTDir)
+    if ( bDayPlots ):
+        jobs = daily.Plots (sLDir, tm) + jobs
+    Render (jobs)
+    lTime.append (('Plots', time.perf_counter () - tStart))
+    Timing (args.timing, lTime)
+
+if __name__ == '__main__':
+    Main ()
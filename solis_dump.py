@@ -2,10 +2,16 @@
 #
 # Decode Solis binary log file to CSV file
 #
+import os
 import sys
-import struct
+import stat
 import time
 import calendar
+import argparse
+import binascii
+import contextlib
+import concurrent.futures
+import numpy as np
 
 all_regs = (
     ('H16', 1, b'\xAA\x55'),                                            #   0
@@ -118,99 +124,289 @@ all_regs = (
     ('T64', -1, 'End data time'),                                        # 296
     ('H16', 1, b'\x55\xAA'))                                            # 304
 
-def datalen ():
-    dlen = 0
-    for type, scl, desc in all_regs:
-        dlen += int (type[1:3])
-    return dlen // 8
+# Fields of the 250 byte cloud capture record (Solis_R250_yyyymmdd.cap) that are
+# understood. See README.md. Unlike the Modbus record all values are little-endian.
+cap_regs = (
+    ('H16', 1, b'\xA5\x5A'),                                            #   0
+    ('U16', 1, 'Record length'),                                        #   2
+    ('T64', -1, 'Capture time'),                                        #   4
+    ('X400', 1, 'Not Used'),                                            #  12
+    ('U16', 10, 'PV 1 Voltage (V)'),                                    #  62
+    ('U16', 10, 'PV 2 Voltage (V)'),                                    #  64
+    ('U16', 10, 'PV 1 Current (A)'),                                    #  66
+    ('U16', 10, 'PV 2 Current (A)'),                                    #  68
+    ('X400', 1, 'Not Used'),                                            #  70
+    ('U16', 1, 'Solar Power (W)'),                                      # 120
+    ('X336', 1, 'Not Used'),                                            # 122
+    ('U16', 10, 'Meter Grid Voltage (V)'),                              # 164
+    ('U16', 10, 'Meter Grid Current (A)'),                              # 166
+    ('S16', 1, 'Meter Power To Grid (W)'),                              # 168
+    ('X16', 1, 'Not Used'),                                             # 170
+    ('U16', 1, 'Energy Storage Mode'),                                  # 172
+    ('U16', 10, 'Battery Voltage (V)'),                                 # 174
+    ('R16+16', 10, 'Battery Current (A)'),                              # 176
+    ('U16', 1, 'Battery Current Direction (0=Charging, 1=Discharging)'),# 178
+    ('X32', 1, 'Not Used'),                                             # 180
+    ('U16', 1, 'Battery Capacity SOC (%)'),                             # 184
+    ('U16', 1, 'Battery Health SOH (%)'),                               # 186
+    ('X96', 1, 'Not Used'),                                             # 188
+    ('U16', 1, 'House Load Power (W)'),                                 # 200
+    ('U16', 1, 'Bypass Load Power (W)'),                                # 202
+    ('X464', 1, 'Not Used'),                                            # 204
+    ('H16', 1, b'\x5A\xA5'))                                            # 262
 
-def header ():
-    ls = []
-    addr = 0
-    for type, scl, desc in all_regs:
-        if ( type[0] not in 'HX' ):
-            ls.append (desc)
-        addr += int (type[1:3]) // 8
-    return '"' + '","'.join (ls) + '"\n'
+def regsize (type):
+    # Size in bytes. Unused gaps may be any number of bits, other types have two digits.
+    if ( type[0] == 'X' ):
+        return int (type[1:]) // 8
+    return int (type[1:3]) // 8
 
-def decode (rec):
-    lv = []
+def datalen (regs = all_regs):
+    dlen = 0
+    for type, scl, desc in regs:
+        dlen += regsize (type)
+    return dlen
+
+def compile_regs (regs):
+    # Convert a register table into a structured dtype for the whole record, a list of the
+    # output columns giving (offset, description, field, type, scale, sign field) for each one,
+    # and the start and end markers
+    names = []
+    formats = []
+    offsets = []
+    columns = []
     addr = 0
-    for type, scl, desc in all_regs:
-        if ( type == 'H16' ):
-            if ( rec[addr:addr+2] != desc ):
-                sys.stderr.write ('Invalid record\n' + str (rec) + '\n')
-                sys.exit (1)
-            addr += 2
-            continue
-        elif ( type == 'T64' ):
-            v = struct.unpack ('<Q', rec[addr:addr+8])[0]
-            addr += 8
+    for type, scl, desc in regs:
+        fld = 'f{:d}'.format (addr)
+        sgn = None
+        if ( type == 'T64' ):
+            fmt = '<u8'
         elif ( type == 'D96' ):
-            v = list (struct.unpack ('<6H', rec[addr:addr+12]))
-            addr += 12
-            v[0] += 2000
-            v = calendar.timegm (v)
-        elif ( type == 'X16' ):
-            addr += 2
-            continue
-        elif ( type == 'U16' ):
-            v = struct.unpack ('<H', rec[addr:addr+2])[0]
-            addr += 2
+            fmt = ('<u2', 6)
+        elif ( type in ('H16', 'U16') or type.startswith ('R16') ):
+            fmt = '<u2'
         elif ( type == 'S16' ):
-            v = struct.unpack ('<H', rec[addr:addr+2])[0]
-            if ( v >= 0x8000 ):
-                v -= 0x10000
-            addr += 2
-        elif ( type.startswith ('R16') ):
-            v = struct.unpack ('<H', rec[addr:addr+2])[0]
-            a2 = addr + int (type[3:]) // 8
-            s = struct.unpack ('<H', rec[a2:a2+2])[0]
-            if ( s > 0 ):
-                v = -v
-            addr += 2
-        elif ( type == 'U32' ):
-            v = struct.unpack ('<2H', rec[addr:addr+4])
-            v = ( v[0] << 16 ) | v[1]
-            addr += 4
-        elif ( type == 'S32' ):
-            v = struct.unpack ('<2H', rec[addr:addr+4])
-            v = ( v[0] << 16 ) | v[1]
-            if ( v >= 0x80000000 ):
-                v -= 0x100000000
-            addr += 4
-        elif ( type.startswith ('R32') ):
-            v = struct.unpack ('<2H', rec[addr:addr+4])
-            v = ( v[0] << 16 ) | v[1]
+            fmt = '<i2'
+        else:
+            fmt = ('<u2', 2)
+        if ( type[0] == 'R' ):
             a2 = addr + int (type[3:]) // 8
-            s = struct.unpack ('<H', rec[a2:a2+2])[0]
-            if ( s > 0 ):
-                v = -v
-            addr += 4
-        if ( scl == 1 ):
-            lv.append ('{:d}'.format (v))
-        elif ( scl == 10 ):
-            lv.append ('{:3.1f}'.format (v/scl))
-        elif ( scl == 100 ):
-            lv.append ('{:4.2f}'.format (v/scl))
-        elif ( scl == 1000 ):
-            lv.append ('{:5.3f}'.format (v/scl))
-        elif ( scl == -1 ):
-            lv.append (time.strftime ('%Y-%m-%d %H:%M:%S', time.gmtime (v)))
-    return ','.join (lv) + '\n'
-
-def dump (sIn, sOut):
-    dlen = datalen ()
-    with open (sIn, 'rb') as fIn, open (sOut, 'w') as fOut:
-        fOut.write (header ())
+            sgn = 's{:d}'.format (a2)
+            if ( sgn not in names ):
+                names.append (sgn)
+                formats.append ('<u2')
+                offsets.append (a2)
+        if ( type[0] != 'X' ):
+            names.append (fld)
+            formats.append (fmt)
+            offsets.append (addr)
+        if ( type[0] not in 'HX' ):
+            columns.append ((addr, desc, fld, type[0:3], scl, sgn))
+        addr += regsize (type)
+    dtype = np.dtype ({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': addr})
+    start = np.frombuffer (regs[0][2], dtype = '<u2')[0]
+    end = np.frombuffer (regs[-1][2], dtype = '<u2')[0]
+    return dtype, columns, start, end
+
+dat_layout = compile_regs (all_regs)
+crc_start = np.frombuffer (b'\xAA\x56', dtype = '<u2')[0]      # Start marker of Modbus records with a CRC-16
+cap_layout = compile_regs (cap_regs)
+
+def file_layout (sIn):
+    if ( sIn.endswith ('.cap') ):
+        return cap_layout
+    return dat_layout
+
+def select_columns (fields, layout = dat_layout):
+    # Select output columns by description (case insensitive) or record offset
+    if ( fields is None ):
+        return layout[1]
+    columns = []
+    for fld in fields.split (','):
+        fld = fld.strip ()
+        for col in layout[1]:
+            if (( fld.isdigit () and int (fld) == col[0] ) or ( fld.lower () == col[1].lower () )):
+                columns.append (col)
+                break
+        else:
+            sys.stderr.write ('Unknown field: {:s}\n'.format (fld))
+            sys.exit (1)
+    return columns
+
+def header (columns = dat_layout[1]):
+    return '"' + '","'.join ([col[1] for col in columns]) + '"\n'
+
+def column (rec, fld, type, sgn):
+    v = rec[fld]
+    if ( type == 'T64' ):
+        v = v.astype (np.int64)
+    elif ( type == 'D96' ):
+        v = v.astype (np.int64)
+        day = (( v[:, 0] + 30 ).astype ('datetime64[Y]').astype ('datetime64[M]') + ( v[:, 1] - 1 )
+               ).astype ('datetime64[D]') + ( v[:, 2] - 1 )
+        v = day.astype (np.int64) * 86400 + v[:, 3] * 3600 + v[:, 4] * 60 + v[:, 5]
+    elif ( type[1:3] == '32' ):
+        v = ( v[:, 0].astype (np.int64) << 16 ) | v[:, 1]
+        if ( type == 'S32' ):
+            v = np.where (v >= 0x80000000, v - 0x100000000, v)
+    else:
+        v = v.astype (np.int64)
+    if ( sgn is not None ):
+        v = np.where (rec[sgn] > 0, -v, v)
+    return v
+
+scale_fmt = { 10: '%3.1f', 100: '%4.2f', 1000: '%5.3f' }
+
+def format_column (v, scl):
+    if ( scl == -1 ):
+        return np.char.replace (np.datetime_as_string (v.astype ('datetime64[s]')), 'T', ' ').tolist ()
+    if ( scl == 1 ):
+        return list (map (str, v.tolist ()))
+    return list (map (scale_fmt[scl].__mod__, ( v / scl ).tolist ()))
+
+def check_crc (buf, rec, reclen):
+    # Verify the CRC-16 held in the unused register at offset 22 by records with the alternate start marker
+    valid = np.ones (len (rec), dtype = bool)
+    for i in np.nonzero (rec['f0'] == crc_start)[0]:
+        r = buf[i*reclen:(i+1)*reclen]
+        valid[i] = ( binascii.crc_hqx (r[:22] + b'\x00\x00' + r[24:], 0) == int.from_bytes (r[22:24], 'little') )
+    return valid
+
+def decode (buf, layout = dat_layout, columns = None):
+    dtype, lcol, start, end = layout
+    if ( columns is None ):
+        columns = lcol
+    rec = np.frombuffer (buf, dtype = dtype)
+    if ( layout is dat_layout ):
+        valid = (( rec['f0'] == start ) | ( rec['f0'] == crc_start )) & ( rec['f{:d}'.format (dtype.itemsize - 2)] == end )
+        valid &= check_crc (buf, rec, dtype.itemsize)
+    else:
+        valid = ( rec['f0'] == start ) & ( rec['f{:d}'.format (dtype.itemsize - 2)] == end )
+    if ( not valid.all () ):
+        i = np.argmin (valid) * dtype.itemsize
+        sys.stderr.write ('Invalid record\n' + str (buf[i:i+dtype.itemsize]) + '\n')
+        sys.exit (1)
+    lc = [format_column (column (rec, fld, type, sgn), scl) for addr, desc, fld, type, scl, sgn in columns]
+    return ''.join ([','.join (row) + '\n' for row in zip (*lc)])
+
+def decode_file (sIn, columns, nblk = 4096):
+    layout = file_layout (sIn)
+    dlen = layout[0].itemsize
+    with open (sIn, 'rb') as fIn:
         while (True):
-            rec = fIn.read (dlen)
-            if ( len (rec) == 0 ):
+            buf = fIn.read (nblk * dlen)
+            buf = buf[:len (buf) - len (buf) % dlen]            # Ignore any partly written record
+            if ( len (buf) == 0 ):
                 break
-            fOut.write (decode (rec))
+            yield decode (buf, layout, columns)
+
+@contextlib.contextmanager
+def replace_file (sOut):
+    # Write to a temporary file, which only replaces sOut once it is complete. Anything other than
+    # a regular file, such as a symbolic link (/dev/stdout) or a pipe, is written directly.
+    if ( os.path.lexists (sOut) and not stat.S_ISREG (os.lstat (sOut).st_mode) ):
+        with open (sOut, 'w') as fOut:
+            yield fOut
+        return
+    sTemp = '{:s}.{:d}.tmp'.format (sOut, os.getpid ())
+    try:
+        with open (sTemp, 'w') as fOut:
+            yield fOut
+    except BaseException:
+        os.remove (sTemp)
+        raise
+    os.replace (sTemp, sOut)
+
+def dump (sIn, sOut, fields = None):
+    columns = select_columns (fields, file_layout (sIn))
+    with replace_file (sOut) as fOut:
+        fOut.write (header (columns))
+        for blk in decode_file (sIn, columns):
+            fOut.write (blk)
+
+def decode_all (sIn, fields):
+    return ''.join (decode_file (sIn, select_columns (fields, file_layout (sIn))))
+
+def find_logs (sRoot, tFrom, tTo, bCapture):
+    # List the (Modbus, capture) log files present for each day in the range
+    lDat = []
+    lCap = []
+    t = calendar.timegm (tFrom)
+    while ( t <= calendar.timegm (tTo) ):
+        tm = time.gmtime (t)
+        sDir = os.path.join (sRoot, '{:04d}'.format (tm.tm_year), '{:02d}'.format (tm.tm_mon))
+        sDay = '{:04d}{:02d}{:02d}'.format (tm.tm_year, tm.tm_mon, tm.tm_mday)
+        sFile = os.path.join (sDir, 'Solis_{:s}.dat'.format (sDay))
+        if ( os.path.exists (sFile) ):
+            lDat.append (sFile)
+        sFile = os.path.join (sDir, 'Solis_R250_{:s}.cap'.format (sDay))
+        if ( bCapture and os.path.exists (sFile) ):
+            lCap.append (sFile)
+        t += 86400
+    return lDat, lCap
+
+def up_to_date (sOut, sIn, fields):
+    # The output is newer than the input, and has the columns selected
+    if ( not ( os.path.exists (sOut) and os.path.getmtime (sOut) > os.path.getmtime (sIn) ) ):
+        return False
+    with open (sOut, 'r') as f:
+        return ( f.readline () == header (select_columns (fields, file_layout (sIn))) )
+
+def dump_split (lIn, sDir, fields, jobs):
+    # One CSV file per day file, converted in parallel
+    os.makedirs (sDir, exist_ok = True)
+    lWork = []
+    for sIn in lIn:
+        sOut = os.path.join (sDir, os.path.splitext (os.path.basename (sIn))[0] + '.csv')
+        sFields = fields if sIn.endswith ('.dat') else None
+        if ( not up_to_date (sOut, sIn, sFields) ):
+            lWork.append ((sIn, sOut, sFields))
+    with concurrent.futures.ProcessPoolExecutor (jobs) as pool:
+        lFut = [pool.submit (dump, sIn, sOut, sFields) for sIn, sOut, sFields in lWork]
+        for fut in lFut:
+            fut.result ()
+
+def dump_joined (lIn, sOut, fields, jobs):
+    # A single CSV file with the day files in order, decoded in parallel. It is always rewritten,
+    # since it depends on the range of days as well as the files.
+    if ( len (lIn) == 0 ):
+        return
+    columns = select_columns (fields, file_layout (lIn[0]))
+    with concurrent.futures.ProcessPoolExecutor (jobs) as pool, replace_file (sOut) as fOut:
+        fOut.write (header (columns))
+        for text in pool.map (decode_all, lIn, [fields] * len (lIn)):
+            fOut.write (text)
+
+def main ():
+    parser = argparse.ArgumentParser (description = 'Decode Solis binary log files to CSV files')
+    parser.add_argument ('--fields', help = 'Comma separated list of register descriptions or record offsets '
+                         'to output (Modbus log files only)')
+    parser.add_argument ('--root', help = 'Convert all log files in this log folder between --from and --to')
+    parser.add_argument ('--from', dest = 'tfrom', help = 'First day to convert (yyyy-mm-dd)')
+    parser.add_argument ('--to', dest = 'tto', help = 'Last day to convert (yyyy-mm-dd), defaults to --from')
+    parser.add_argument ('--capture', action = 'store_true', help = 'Also convert cloud capture files')
+    parser.add_argument ('--split', action = 'store_true', help = 'Write one CSV file per day into the output folder')
+    parser.add_argument ('--jobs', type = int, help = 'Number of worker processes')
+    parser.add_argument ('files', nargs = '+', help = '<log file> <csv file>, or with --root the output '
+                         'CSV file (capture data goes to <csv file>_R250.csv) or folder')
+    args = parser.parse_args ()
+    if ( args.root is None ):
+        if ( len (args.files) != 2 ):
+            parser.error ('expected <log file> <csv file>')
+        dump (args.files[0], args.files[1], args.fields)
+        return
+    if (( args.tfrom is None ) or ( len (args.files) != 1 )):
+        parser.error ('--root requires --from and a single output')
+    tFrom = time.strptime (args.tfrom, '%Y-%m-%d')
+    tTo = time.strptime (args.tto or args.tfrom, '%Y-%m-%d')
+    lDat, lCap = find_logs (args.root, tFrom, tTo, args.capture)
+    sOut = args.files[0]
+    if ( args.split ):
+        dump_split (lDat + lCap, sOut, args.fields, args.jobs)
+    else:
+        dump_joined (lDat, sOut, args.fields, args.jobs)
+        sStem, sExt = os.path.splitext (sOut)
+        dump_joined (lCap, sStem + '_R250' + ( sExt or '.csv' ), None, args.jobs)
 
-if ( len (sys.argv) == 3 ):
-    dump (sys.argv[1], sys.argv[2])
-else:
-    sys.stderr.write ('Usage: solis_dump.py <log file> <csv file>\n')
-    sys.exit (1)
+if __name__ == "__main__":
+    main ()
@@ -2,63 +2,495 @@
 """Query Solis Data Logger to collect Statistics"""
 
 import umodbus.client.tcp
+import umodbus.exceptions
+import configparser
+import argparse
+import asyncio
 import socket
 import struct
+import signal
+import binascii
 import time
 import os
 import sys
+import random
+
+sid = 1
+port = 502
+registers = ((33022, 33041), (33049, 33059), (33071, 33085), (33091, 33096),
+             (33100, 33107), (33126, 33151), (33161, 33181), (33251, 33287),
+             (33115, 33122))
+max_regs = 125                  # Modbus limit on the number of registers in one read
+max_gap = 16                    # Read across gaps of up to this many registers rather than make another request
+max_tries = 3                   # Attempts to read each block before giving up
+max_connect = 4                 # Attempts to connect in a single query
+timeout_min = 1.0               # Limits on the adaptive read timeout (seconds)
+timeout_max = 20.0
+retry_base = 0.5                # Backoff before the first retry of a read (seconds)
+reset_base = 15                 # Backoff before the first reconnection after a reset (seconds)
+reset_max = 105
+log_batch = 1                   # Records held before writing them to the log file
+log_flush = 0                   # Seconds a record may be held before writing it
+log_fsync = 'never'             # When to fsync the log file: never, batch or close
+log_checksum = False            # Write records holding a CRC-16
+
+class ReadError (Exception):
+    pass
+
+def timestamp ():
+    return time.strftime ('%Y-%m-%d %H:%M:%S')
+
+def backoff (n, base, cap):
+    """Exponential backoff, with jitter, before the n'th retry (counting from 0)"""
+    t = min (cap, base * 2 ** n)
+    return random.uniform (t / 2, t)
+
+class Timing:
+    """Smoothed round trip time of register reads, giving an adaptive timeout (as for TCP in RFC 6298)"""
+    def __init__ (self, tmax = timeout_max):
+        self.tmax = tmax
+        self.srtt = None
+        self.rttvar = None
+        self.rto = tmax
+
+    def update (self, rtt):
+        if ( self.srtt is None ):
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs (self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min (self.tmax, max (timeout_min, self.srtt + 4 * self.rttvar))
+
+    def expired (self):
+        self.rto = min (self.tmax, 2 * self.rto)
+
+    def timeout (self):
+        return self.rto
+
+class Metrics:
+    """Attempts and latency of each read in one poll, kept as a line of a CSV side file"""
+    def __init__ (self):
+        self.tstart = time.time ()
+        self.t0 = time.monotonic ()
+        self.nconn = 0
+        self.blocks = {}                    # First register of read: [attempts, latency]
+
+    def read (self, fst, attempt, latency = None):
+        self.blocks[fst] = [attempt, latency]
+
+    def file (self, logdir):
+        return log_file (logdir, self.tstart)[:-4] + '_poll.csv'
+
+    def header (self):
+        return 'Time,OK,Connects,Total ms,Timeout ms' + ''.join ([',Tries {0:d},ms {0:d}'.format (fst) for fst, lst in reads]) + '\n'
+
+    def line (self, bOK, timing):
+        line = '{:d},{:d},{:d},{:.0f},{:.0f}'.format (int (self.tstart), int (bOK), self.nconn,
+                                                     1000 * ( time.monotonic () - self.t0 ), 1000 * timing.timeout ())
+        for fst, lst in reads:
+            attempt, latency = self.blocks.get (fst, [0, None])
+            line += ',{:d},'.format (attempt)
+            if ( latency is not None ):
+                line += '{:.0f}'.format (1000 * latency)
+        return line + '\n'
+
+def plan_reads (blocks, maxgap = max_gap, maxregs = max_regs):
+    """Coalesce register blocks (first, last + 1) into the fewest reads of no more than maxregs
+    registers, reading across gaps of no more than maxgap unwanted registers"""
+    reads = []
+    for fst, lst in sorted (blocks):
+        if ( len (reads) > 0 and fst - reads[-1][1] <= maxgap and max (lst, reads[-1][1]) - reads[-1][0] <= maxregs ):
+            reads[-1][1] = max (lst, reads[-1][1])
+        else:
+            while ( lst - fst > maxregs ):
+                reads.append ([fst, fst + maxregs])
+                fst += maxregs
+            reads.append ([fst, lst])
+    return [(fst, lst) for fst, lst in reads]
+
+reads = plan_reads (registers)
+
+def split_reads ():
+    """After an exception reply to a read across gaps, which the logger may not allow, read each
+    block separately from then on. Returns False if the blocks are already read separately"""
+    global reads
+    separate = plan_reads (registers, -1)
+    if ( reads == separate ):
+        return False
+    sys.stderr.write ('{:s} Exception reply to a read across gaps, reading each block separately\n'.format (timestamp ()))
+    reads = separate
+    return True
+
+class Connection:
+    """TCP connection to a data logger, opened when next needed after it is closed"""
+    def __init__ (self, addr):
+        self.addr = addr
+        self.sock = None
+
+    def open (self, metrics):
+        if ( self.sock is None ):
+            metrics.nconn += 1
+            self.sock = socket.create_connection ((self.addr, port), timeout = timeout_max)
+        return self.sock
+
+    def close (self):
+        if ( self.sock is not None ):
+            self.sock.close ()
+            self.sock = None
+
+def read_record (conn, timing, metrics):
+    """Read all the registers and return them as a log file record"""
+    tstart = int (time.time ())
+    vals = {}
+    for fst, lst in reads:
+        req = umodbus.client.tcp.read_input_registers (sid, fst, lst - fst)
+        bFail = True
+        for attempt in range (max_tries):
+            metrics.read (fst, attempt + 1)
+            sock = conn.open (metrics)
+            sock.settimeout (timing.timeout ())
+            t0 = time.monotonic ()
+            try:
+                vals[fst] = umodbus.client.tcp.send_message (req, sock)
+                bFail = False
+                break
+            except umodbus.exceptions.ModbusError:
+                if ( not split_reads () ):
+                    raise
+                metrics.blocks = {}
+                return read_record (conn, timing, metrics)
+            except socket.timeout:                                  # Not a TimeoutError before Python 3.10
+                timing.expired ()
+                # A late response could be taken as the answer to the retry, so retry on a new connection
+                conn.close ()
+                if ( attempt + 1 < max_tries ):
+                    time.sleep (backoff (attempt, retry_base, timeout_max))
+        if ( bFail ):
+            raise ReadError ('Failed to read registers ({:d}, {:d})'.format (fst, lst))
+        latency = time.monotonic () - t0
+        timing.update (latency)
+        metrics.read (fst, attempt + 1, latency)
+    return make_record (tstart, vals, int (time.time ()))
+
+def make_record (tstart, vals, tend):
+    """Assemble the values of each read, keyed by first register, in the order of the record layout"""
+    rec = b'\xAA\x55' + struct.pack ('<Q', tstart)
+    for fst, lst in registers:
+        for rfst, rlst in reads:
+            if ( rfst <= fst and lst <= rlst ):
+                rec += struct.pack ('<{:d}H'.format (lst - fst), *vals[rfst][fst - rfst : lst - rfst])
+                break
+    rec += struct.pack ('<Q', tend)
+    rec += b'\x55\xAA'
+    return rec
+
+def log_file (logdir, t):
+    """Path of the log file for the UTC day containing time t"""
+    tm = time.gmtime (t)
+    dir = '{:s}/{:04d}/{:02d}'.format (logdir, tm.tm_year, tm.tm_mon)
+    os.makedirs (dir, exist_ok=True)
+    fname = 'Solis_{:04d}{:02d}{:02d}.dat'.format (tm.tm_year, tm.tm_mon, tm.tm_mday)
+    return os.path.join (dir, fname)
 
 def query (addr, logdir):
-    sid = 1
-    registers = ((33022, 33041), (33049, 33059), (33071, 33085), (33091, 33096),
-                 (33100, 33107), (33126, 33151), (33161, 33181), (33251, 33287),
-                 (33115, 33122))
+    timing = Timing ()
+    metrics = Metrics ()
+    log = LogFile (logdir, fsync = log_fsync, bChecksum = log_checksum)
+    conn = Connection (addr)
     nTry = 0
-    while ( nTry < 2 ):
+    while ( nTry < max_connect ):
         nTry += 1
         try:
-            fst = 0
-            lst = 0
-            rec = b'\xAA\x55'
-            rec += struct.pack ('<Q', int (time.time ()))
-            sock = socket.create_connection ((addr, 502), timeout = 20)
-            for fst, lst in registers:
-                req = umodbus.client.tcp.read_input_registers (sid, fst, lst - fst)
-                bFail = True
-                for attempt in range (3):
-                    try:
-                        val = umodbus.client.tcp.send_message (req, sock)
-                        bFail = False
-                        break
-                    except TimeoutError:
-                        pass
-                if ( bFail ):
-                    sock.close ()
-                    sys.stderr.write ('Failed to read registers ({:d}, {:d})\n'.format (fst, lst))
-                    sys.exit (1)
-                for v in val:
-                    rec += struct.pack ('<H', v)
-            sock.close ()
+            rec = read_record (conn, timing, metrics)
+            conn.close ()
             break
+        except (ReadError, umodbus.exceptions.ModbusError) as e:     # ModbusError if the logger sends an exception reply
+            conn.close ()
+            sys.stderr.write ('{:s} {:s}: {:s}\n'.format (timestamp (), type (e).__name__, ' '.join (str (e).split ())))
+            log.metrics (metrics, False, timing)
+            log.close ()
+            sys.exit (1)
         except ConnectionResetError:
-            if ( fst == 0 ):
-                sys.stderr.write ('{:s} Try {:d} - Connection reset on open\n'
-                                  .format (time.strftime ('%Y-%m-%d %H:%M:%S'), nTry))
+            if ( conn.sock is None ):
+                sys.stderr.write ('{:s} Try {:d} - Connection reset on open\n'.format (timestamp (), nTry))
             else:
-                sys.stderr.write ('{:s} Try {:d} - Connection reset reading registers ({:d{, {:d})\n'
-                                  .format (time.strftime ('%Y-%m-%d %H:%M:%S'), nTry, fst, lst))
-            if ( nTry == 2 ):
+                conn.close ()
+                sys.stderr.write ('{:s} Try {:d} - Connection reset reading registers\n'.format (timestamp (), nTry))
+            if ( nTry == max_connect ):
+                log.metrics (metrics, False, timing)
+                log.close ()
                 sys.exit (1)
-            time.sleep (105)
-    rec += struct.pack ('<Q', int (time.time ()))
-    rec += b'\x55\xAA'
+            time.sleep (backoff (nTry - 1, reset_base, reset_max))
     if ( len (rec) == 306 ):
-        tm = time.gmtime (time.time ())
-        dir = '{:s}/{:04d}/{:02d}'.format (logdir, tm.tm_year, tm.tm_mon)
-        os.makedirs (dir, exist_ok=True)
-        fname = 'Solis_{:04d}{:02d}{:02d}.dat'.format (tm.tm_year, tm.tm_mon, tm.tm_mday)
-        with open (os.path.join (dir, fname), 'ab') as f:
-            f.write (rec)
-        
+        log.write (rec)
+    log.metrics (metrics, len (rec) == 306, timing)
+    log.close ()
+
+def record_crc (rec):
+    """CRC-16 of a record, taken with the checksum field (reserved register 33028) zero"""
+    return binascii.crc_hqx (rec[:22] + b'\x00\x00' + rec[24:], 0)
+
+def add_checksum (rec):
+    """Change the start marker to show that the record holds a checksum, and insert it"""
+    rec = b'\xAA\x56' + rec[2:]
+    return rec[:22] + struct.pack ('<H', record_crc (rec)) + rec[24:]
+
+class LogFile:
+    """Append records to the log file for their UTC day. Records are held in memory and written in
+    batches, when nbatch records are held or the oldest has been held for tflush seconds. Each batch
+    is a single write of whole records, and any partly written record left by a crash is removed
+    when the file is opened, so readers only ever see complete records. The fsync policy is
+    'never', 'batch' (after each write) or 'close' (when the file is closed). The metrics line of
+    each poll is held in the same way, and written to the poll file with each batch of records"""
+    def __init__ (self, logdir, nbatch = 1, tflush = 0, fsync = 'never', bChecksum = False):
+        self.logdir = logdir
+        self.nbatch = nbatch
+        self.tflush = tflush
+        self.fsync = fsync
+        self.bChecksum = bChecksum
+        self.fname = None
+        self.fd = None
+        self.recs = []
+        self.lines = []                     # Metrics lines held: (poll file, header, line)
+        self.tfirst = None
+        self.pollname = None                # Poll file written last, and its current header
+        self.pollhdr = None
+
+    def open (self, fname, reclen):
+        self.close ()
+        self.fname = fname
+        self.fd = os.open (fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        nlen = os.fstat (self.fd).st_size
+        if ( nlen % reclen != 0 ):
+            sys.stderr.write ('{:s} Removing partial record from {:s}\n'.format (timestamp (), fname))
+            os.ftruncate (self.fd, nlen - nlen % reclen)
+
+    def write (self, rec):
+        if ( self.bChecksum ):
+            rec = add_checksum (rec)
+        fname = log_file (self.logdir, struct.unpack ('<Q', rec[2:10])[0])
+        if ( fname != self.fname ):
+            self.open (fname, len (rec))
+        if ( len (self.recs) + len (self.lines) == 0 ):
+            self.tfirst = time.monotonic ()
+        self.recs.append (rec)
+        self.check ()
+
+    def metrics (self, metrics, bOK, timing):
+        """Hold the metrics line of a poll"""
+        if ( len (self.recs) + len (self.lines) == 0 ):
+            self.tfirst = time.monotonic ()
+        self.lines.append ((metrics.file (self.logdir), metrics.header (), metrics.line (bOK, timing)))
+
+    def check (self):
+        """Write the held records if either threshold has been reached"""
+        if (( len (self.recs) >= self.nbatch ) or
+            (( len (self.recs) + len (self.lines) > 0 ) and ( time.monotonic () - self.tfirst >= self.tflush ))):
+            self.flush ()
+
+    def flush (self):
+        if ( len (self.recs) > 0 ):
+            buf = memoryview (b''.join (self.recs))
+            self.recs = []
+            while ( len (buf) > 0 ):
+                buf = buf[os.write (self.fd, buf):]
+            if ( self.fsync == 'batch' ):
+                os.fsync (self.fd)
+        if ( len (self.lines) > 0 ):
+            self.flush_metrics ()
+
+    def flush_metrics (self):
+        # A header line is written when the columns differ from those of the file, as for a new file
+        lines = self.lines
+        self.lines = []
+        f = None
+        for fname, header, line in lines:
+            if ( fname != self.pollname ):
+                self.pollname = fname
+                self.pollhdr = None
+                if ( os.path.exists (fname) ):
+                    with open (fname, 'r') as fr:
+                        self.pollhdr = fr.readline ()
+            if (( f is None ) or ( f.name != fname )):
+                if ( f is not None ):
+                    f.close ()
+                f = open (fname, 'a')
+            if ( header != self.pollhdr ):
+                f.write (header)
+                self.pollhdr = header
+            f.write (line)
+        f.close ()
+
+    def close (self):
+        self.flush ()
+        if ( self.fd is not None ):
+            if ( self.fsync != 'never' ):
+                os.fsync (self.fd)
+            os.close (self.fd)
+            self.fd = None
+            self.fname = None
+
+def next_poll (tnext, tnow, interval):
+    """Time of the next poll on a fixed schedule, skipping any polls already missed"""
+    tnext += interval
+    if ( tnext <= tnow ):
+        tnext += interval * ( int (( tnow - tnext ) / interval ) + 1 )
+    return tnext
+
+def daemon (addr, logdir, interval):
+    """Poll the registers every interval seconds over a single connection, reconnecting
+    when necessary, and append the records to the log file for the current UTC day"""
+    conn = Connection (addr)
+    log = LogFile (logdir, log_batch, log_flush, log_fsync, log_checksum)
+    timing = Timing ()
+    nFail = 0
+    tnext = time.monotonic ()
+    try:
+        while (True):
+            metrics = Metrics ()
+            bOK = False
+            try:
+                rec = read_record (conn, timing, metrics)
+                if ( len (rec) == 306 ):
+                    log.write (rec)
+                    bOK = True
+            # ValueError if the logger closes the connection, ModbusError if it sends an exception reply
+            except (ReadError, OSError, ValueError, umodbus.exceptions.ModbusError) as e:
+                sys.stderr.write ('{:s} {:s}: {:s}\n'.format (timestamp (), type (e).__name__, ' '.join (str (e).split ())))
+                conn.close ()
+            log.metrics (metrics, bOK, timing)
+            log.check ()
+            tnow = time.monotonic ()
+            # After failures, wait with increasing backoff before trying the logger again
+            if ( bOK ):
+                nFail = 0
+                tnext = next_poll (tnext, tnow, interval)
+            else:
+                nFail += 1
+                tnext = next_poll (tnext, tnow + backoff (nFail - 1, interval, reset_max) - interval, interval)
+            time.sleep (tnext - tnow)
+    finally:
+        log.close ()
+
+async def read_async (reader, writer, timing, metrics):
+    """Read all the registers over an asyncio stream and return them as a log file record.
+    There are no retries: after a timeout a late response could be taken as the answer to
+    the next request, so the caller must drop the connection instead"""
+    tstart = int (time.time ())
+    vals = {}
+    for fst, lst in reads:
+        req = umodbus.client.tcp.read_input_registers (sid, fst, lst - fst)
+        metrics.read (fst, 1)
+        t0 = time.monotonic ()
+        try:
+            writer.write (req)
+            await writer.drain ()
+            hdr = await asyncio.wait_for (reader.readexactly (7), timing.timeout ())
+            body = await asyncio.wait_for (reader.readexactly (struct.unpack ('>H', hdr[4:6])[0] - 1),
+                                           timing.timeout ())
+        except asyncio.TimeoutError:                                # Not a TimeoutError before Python 3.11
+            timing.expired ()
+            raise
+        try:
+            vals[fst] = umodbus.client.tcp.parse_response_adu (hdr + body, req)
+        except umodbus.exceptions.ModbusError:
+            if ( not split_reads () ):
+                raise
+            metrics.blocks = {}
+            return await read_async (reader, writer, timing, metrics)
+        latency = time.monotonic () - t0
+        timing.update (latency)
+        metrics.read (fst, 1, latency)
+    return make_record (tstart, vals, int (time.time ()))
+
+async def poll_site (name, site, t0, interval):
+    """Poll one data logger on the schedule shared by all sites"""
+    timing = Timing (site.getfloat ('timeout', timeout_max))
+    reader = writer = None
+    log = LogFile (site['logdir'], site.getint ('batch', log_batch), site.getfloat ('flush', log_flush),
+                   site.get ('fsync', log_fsync), site.getboolean ('checksum', log_checksum))
+    loop = asyncio.get_running_loop ()
+    nFail = 0
+    tnext = t0
+    try:
+        while (True):
+            metrics = Metrics ()
+            bOK = False
+            try:
+                if ( writer is None ):
+                    metrics.nconn += 1
+                    reader, writer = await asyncio.wait_for (asyncio.open_connection (site['addr'], site.getint ('port', port)),
+                                                             timing.tmax)
+                rec = await read_async (reader, writer, timing, metrics)
+                if ( len (rec) == 306 ):
+                    log.write (rec)
+                    bOK = True
+            except (OSError, ValueError, EOFError, asyncio.TimeoutError, umodbus.exceptions.ModbusError) as e:
+                sys.stderr.write ('{:s} {:s} {:s}: {:s}\n'.format (timestamp (), name, type (e).__name__, ' '.join (str (e).split ())))
+                if ( writer is not None ):
+                    writer.close ()
+                    reader = writer = None
+            log.metrics (metrics, bOK, timing)
+            log.check ()
+            tnow = loop.time ()
+            if ( bOK ):
+                nFail = 0
+                tnext = next_poll (tnext, tnow, interval)
+            else:
+                nFail += 1
+                tnext = next_poll (tnext, tnow + backoff (nFail - 1, interval, reset_max) - interval, interval)
+            await asyncio.sleep (tnext - tnow)
+    finally:
+        log.close ()
+
+async def run_site (name, site, t0, interval):
+    """Poll one data logger, restarting after any unexpected error so that the other sites are not stopped"""
+    nFail = 0
+    while (True):
+        try:
+            await poll_site (name, site, t0, interval)
+        except Exception as e:
+            sys.stderr.write ('{:s} {:s} stopped by {:s}: {:s}\n'.format (timestamp (), name, type (e).__name__, str (e)))
+        await asyncio.sleep (backoff (nFail, interval, reset_max))
+        nFail += 1
+
+async def poll_all (config, interval):
+    """Poll every data logger in the configuration concurrently"""
+    t0 = asyncio.get_running_loop ().time ()
+    await asyncio.gather (*[run_site (name, config[name], t0, interval) for name in config.sections ()])
+
 if __name__ == "__main__":
-    query (sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser (description = 'Query Solis Data Logger to collect Statistics')
+    parser.add_argument ('--daemon', action = 'store_true', help = 'Keep running, polling every --interval seconds')
+    parser.add_argument ('--interval', type = float, default = 10, help = 'Seconds between polls in daemon mode')
+    parser.add_argument ('--port', type = int, default = port, help = 'Modbus TCP port of the data logger')
+    parser.add_argument ('--gap', type = int, default = max_gap,
+                         help = 'Largest gap of unwanted registers to read across (-1 to read each block separately)')
+    parser.add_argument ('--config', help = 'Configuration file listing data loggers to poll concurrently')
+    parser.add_argument ('addr', nargs = '?', help = 'IP address of the data logger')
+    parser.add_argument ('logdir', nargs = '?', help = 'Top level directory to receive logged data')
+    parser.add_argument ('--batch', type = int, default = log_batch, help = 'Records to hold before writing them to the log file')
+    parser.add_argument ('--flush', type = float, default = log_flush, help = 'Seconds a record may be held before writing it')
+    parser.add_argument ('--fsync', choices = ('never', 'batch', 'close'), default = log_fsync,
+                         help = 'When to fsync the log file')
+    parser.add_argument ('--checksum', action = 'store_true', help = 'Write records holding a CRC-16')
+    args = parser.parse_args ()
+    port = args.port
+    log_batch = args.batch
+    log_flush = args.flush
+    log_fsync = args.fsync
+    log_checksum = args.checksum
+    signal.signal (signal.SIGTERM, lambda signum, frame: sys.exit (0))     # Write any held records when stopped
+    reads = plan_reads (registers, args.gap)
+    if ( args.config is not None ):
+        config = configparser.ConfigParser ()
+        if ( len (config.read (args.config)) == 0 ):
+            parser.error ('Unable to read configuration file ' + args.config)
+        asyncio.run (poll_all (config, config['DEFAULT'].getfloat ('interval', args.interval)))
+    elif ( args.logdir is None ):
+        parser.error ('Data logger address and log directory are required')
+    elif ( args.daemon ):
+        daemon (args.addr, args.logdir, args.interval)
+    else:
+        query (args.addr, args.logdir)
@@ -0,0 +1,210 @@
+#!/usr/bin/python3
+#
+# Web server for the Solis HTML pages.
+#
+# Serves the static pages, and answers requests for htbin/solis_data.py from decoded
+# records held in memory rather than running the CGI program for each request.
+#
+import os
+import sys
+import time
+import bisect
+import argparse
+import threading
+import urllib.parse
+import http.server
+
+sHtmlDir = '/home/pi/pysolis/html'
+sDataUrl = '/htbin/solis_data.py'
+sStreamUrl = '/htbin/solis_stream'
+tPoll = 2                           # Seconds between checks for new data to stream
+tKeepAlive = 30                     # Seconds between messages to idle streams
+nCache = 4                          # Number of days of data to keep in memory
+
+class DayFile:
+    # Decoded records of one day file, extended as the file grows
+    def __init__ (self, src):
+        self.src = src
+        self.nread = 0
+        self.recs = []
+        self.times = []
+        self.lock = threading.Lock ()
+
+    def Refresh (self):
+        with self.lock:
+            try:
+                nlen = os.path.getsize (self.src.sPath)
+            except OSError:
+                return
+            nlen -= nlen % self.src.reclen                      # Ignore any partly written record
+            if ( nlen < self.nread ):
+                self.nread = 0                                  # File replaced, start again
+                self.recs = []
+                self.times = []
+            if ( nlen == self.nread ):
+                return
+            with open (self.src.sPath, 'rb') as f:
+                f.seek (self.nread)
+                buf = f.read (nlen - self.nread)
+            for i in range (0, len (buf), self.src.reclen):
+                r = self.src.Decode (buf[i:i+self.src.reclen])
+                if ( r is not None ):
+                    self.recs.append (r)
+                    self.times.append (r[0])
+            self.nread = nlen
+
+    def Records (self, treq):
+        with self.lock:
+            recs = self.recs
+            irec = bisect.bisect_left (self.times, treq)
+        return ( recs[i] for i in range (irec, len (recs)) )
+
+class DataCache:
+    # The most recently used day files
+    def __init__ (self):
+        self.days = {}
+        self.lock = threading.Lock ()
+
+    def Day (self, tday):
+        with self.lock:
+            if ( tday not in self.days ):
+                if ( len (self.days) >= nCache ):
+                    del self.days[min (self.days, key = lambda t: self.days[t][2])]
+                tm = time.gmtime (tday)
+                self.days[tday] = [DayFile (solis_data.Source1 (tm)), DayFile (solis_data.Source2 (tm)), 0]
+            day = self.days[tday]
+            day[2] = time.monotonic ()
+            return day[0], day[1]
+
+class Handler (http.server.SimpleHTTPRequestHandler):
+    def do_GET (self):
+        url = urllib.parse.urlsplit (self.path)
+        if ( url.path == sDataUrl ):
+            self.SendData (url.query)
+        elif ( url.path == sStreamUrl ):
+            self.SendStream (url.query)
+        else:
+            super ().do_GET ()
+
+    def SendData (self, sQuery):
+        query = urllib.parse.parse_qs (sQuery)
+        tlast = [0, 0]
+        try:
+            treq = int (query['From'][0])
+            tend = solis_data.GetTo (query)
+            if ( tend is None ):
+                d1, d2 = cache.Day (treq - treq % 86400)
+                lPath = [d1.src.sPath, d2.src.sPath]
+            else:
+                lPath = solis_data.DayPaths (treq, tend)
+            bBinary = solis_data.WantBinary (query, self.headers.get ('Accept', ''))
+            sTag, tmod = solis_data.Validators (lPath, sQuery, bBinary)
+            lHdr = solis_data.CacheHeaders (sTag, tmod)
+            if ( solis_data.NotModified (sTag, tmod, self.headers.get ('If-None-Match'),
+                                         self.headers.get ('If-Modified-Since')) ):
+                self.send_response (304)
+                for k, v in lHdr:
+                    self.send_header (k, v)
+                self.end_headers ()
+                return
+            if ( tend is None ):
+                d1.Refresh ()
+                d2.Refresh ()
+                it1 = d1.Records (treq)
+                it2 = d2.Records (treq)
+            else:
+                # Ranges are read from the day files as they are sent, rather than cached
+                it1 = solis_data.DayRecords (solis_data.Source1, treq, tend)
+                it2 = solis_data.DayRecords (solis_data.Source2, treq, tend)
+            recs = iter (solis_data.Downsample (solis_data.Merge (it1, it2, tlast), treq, query, tend))
+        except (KeyError, ValueError):
+            self.send_error (400, 'Invalid or missing parameters')
+            return
+        # Rows are sent as they are generated, so the response is ended by closing the connection
+        self.send_response (200)
+        self.send_header ('Content-type', 'application/octet-stream' if bBinary else 'text/csv')
+        for k, v in lHdr:
+            self.send_header (k, v)
+        self.send_header ('Connection', 'close')
+        self.end_headers ()
+        self.close_connection = True
+        if ( bBinary ):
+            for buf in solis_data.Binary (recs, tlast):
+                self.wfile.write (buf)
+            return
+        lrow = []
+        for r in recs:
+            lrow.append (solis_data.Format (r))
+            if ( len (lrow) >= 1024 ):
+                self.wfile.write (''.join (lrow).encode ('ascii'))
+                lrow = []
+        lrow.append ('{:d},{:d}\n'.format (tlast[0], tlast[1]))
+        self.wfile.write (''.join (lrow).encode ('ascii'))
+
+    def SendStream (self, sQuery):
+        # Server-Sent Events: each message holds the new rows in the same CSV format as the data
+        # request, including the final line of last Modbus and capture times. The two files are
+        # written independently, so a record may arrive after a later one from the other source:
+        # the time of the last row sent is kept for each source, and the event id holds both, so
+        # a reconnecting client continues where it left off.
+        try:
+            treq = int (urllib.parse.parse_qs (sQuery)['From'][0])
+            lreq = [treq, treq]                                 # Time of the next record wanted from each source
+            if ( self.headers.get ('Last-Event-ID') ):
+                lid = [int (s) for s in self.headers.get ('Last-Event-ID').split (',')]
+                lreq = [max (treq, lid[0] + 1), max (treq, lid[-1] + 1)]
+        except (KeyError, ValueError):
+            self.send_error (400, 'Invalid or missing From parameter')
+            return
+        self.send_response (200)
+        self.send_header ('Content-type', 'text/event-stream')
+        self.send_header ('Cache-Control', 'no-cache')
+        self.end_headers ()
+        self.close_connection = True
+        tlast = [0, 0]
+        tsend = time.monotonic ()
+        tday = min (lreq) - min (lreq) % 86400
+        try:
+            while (True):
+                d1, d2 = cache.Day (tday)
+                d1.Refresh ()
+                d2.Refresh ()
+                recs = list (solis_data.Merge (d1.Records (max (lreq[0], tday)), d2.Records (max (lreq[1], tday)), tlast))
+                if ( len (recs) > 0 ):
+                    lreq = [max (lreq[0], tlast[0] + 1), max (lreq[1], tlast[1] + 1)]
+                    lrow = ['data: ' + solis_data.Format (r) for r in recs]
+                    lrow.append ('data: {:d},{:d}\n'.format (tlast[0], tlast[1]))
+                    self.wfile.write (('id: {:d},{:d}\n'.format (lreq[0] - 1, lreq[1] - 1) + ''.join (lrow) + '\n').encode ('ascii'))
+                    self.wfile.flush ()
+                    tsend = time.monotonic ()
+                elif ( time.time () >= tday + 86400 + tPoll ):
+                    tday += 86400                                   # Day complete, move on to the next
+                elif ( time.monotonic () - tsend >= tKeepAlive ):
+                    self.wfile.write (b': keep alive\n\n')
+                    self.wfile.flush ()
+                    tsend = time.monotonic ()
+                time.sleep (tPoll)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message (self, format, *args):
+        pass
+
+def Main ():
+    global solis_data, cache
+    parser = argparse.ArgumentParser (description = 'Web server for the Solis HTML pages')
+    parser.add_argument ('--port', type = int, default = 8080, help = 'Port to listen on')
+    parser.add_argument ('--log', help = 'Root folder for logged data')
+    parser.add_argument ('html', nargs = '?', default = sHtmlDir, help = 'Root folder for web interface')
+    args = parser.parse_args ()
+    sys.path.insert (0, os.path.join (args.html, 'htbin'))
+    import solis_data
+    if ( args.log is not None ):
+        solis_data.sLog = args.log
+    cache = DataCache ()
+    handler = lambda *hargs, **kwargs: Handler (*hargs, directory = args.html, **kwargs)
+    server = http.server.ThreadingHTTPServer (('', args.port), handler)
+    server.serve_forever ()
+
+if __name__ == "__main__":
+    Main ()